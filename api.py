@@ -0,0 +1,269 @@
+"""Versioned JSON API for Warbler.
+
+Serves the same lists as the HTML pages (the home timeline, a user's
+messages, followers/following and user search) from the same queries,
+for logged in users:
+
+    GET /api/v1/timeline?before=<cursor>
+    GET /api/v1/users/<id>/messages?before=<cursor>
+    GET /api/v1/users/<id>/following?after=<cursor>
+    GET /api/v1/users/<id>/followers?after=<cursor>
+    GET /api/v1/users?q=<term>&after=<cursor>
+
+Responses are {"data": [...], "next_cursor": ...}; pass next_cursor back as
+`before`/`after` for the next page, which is null on the last one. Lists
+take `limit` (up to the HTML page size) and `fields`, a comma separated
+subset of the fields below, so clients can trim what's sent and what's
+looked up (`liked` and `following` each cost a query).
+
+Bodies are serialized with orjson if it's installed, unless API_FAST_JSON
+is turned off.
+"""
+
+import json
+from datetime import datetime
+
+from flask import Blueprint, current_app, g, request
+from werkzeug.exceptions import BadRequest, HTTPException
+
+from models import Like, Message, TimelineEntry, User
+from pagination import decode_cursor, keyset_page
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Fields of each kind of item: name -> function of (row, context), where
+# context holds the lookups for the page (see message_list, user_list)
+MESSAGE_FIELDS = {
+    'id': lambda message, context: message.id,
+    'text': lambda message, context: message.text,
+    'timestamp': lambda message, context: message.timestamp,
+    'author': lambda message, context: {
+        'id': message.author.id,
+        'username': message.author.username,
+        'image_url': message.author.image_url,
+    },
+    'liked': lambda message, context: message.id in context['liked_ids'],
+}
+
+USER_FIELDS = {
+    'id': lambda user, context: user.id,
+    'username': lambda user, context: user.username,
+    'image_url': lambda user, context: user.image_url,
+    'header_image_url': lambda user, context: user.header_image_url,
+    'bio': lambda user, context: user.bio,
+    'following': lambda user, context: user.id in context['following_ids'],
+}
+
+
+def json_response(payload, status=200):
+    """Return a response with `payload` serialized as JSON.
+
+    orjson is much faster than the json module on long lists of messages,
+    and writes datetimes as ISO 8601 itself, as the fallback does.
+    """
+
+    if orjson and current_app.config['API_FAST_JSON']:
+        body = orjson.dumps(payload)
+    else:
+        body = json.dumps(
+            payload,
+            separators=(',', ':'),
+            ensure_ascii=False,
+            default=lambda value: value.isoformat(),
+        )
+
+    return current_app.response_class(
+        body, status=status, mimetype='application/json')
+
+
+def selected_fields(available):
+    """Return the names of the fields asked for in the 'fields' param.
+
+    All of `available` if none are asked for. Raises BadRequest for names
+    that aren't available.
+    """
+
+    fields = request.args.get('fields')
+    if not fields:
+        return list(available)
+
+    names = set(fields.split(','))
+    unknown = names - set(available)
+    if unknown:
+        raise BadRequest(f"Unknown fields: {', '.join(sorted(unknown))}.")
+
+    return [name for name in available if name in names]
+
+
+def page_size(per_page):
+    """Return the page size asked for with 'limit', at most `per_page`."""
+
+    limit = request.args.get('limit', per_page, type=int)
+
+    if limit < 1:
+        raise BadRequest("Invalid limit.")
+
+    return min(limit, per_page)
+
+
+def serialize(rows, fields, available, context):
+    """Return a list of dicts of `fields` of each of `rows`."""
+
+    getters = [(name, available[name]) for name in fields]
+
+    return [
+        {name: get(row, context) for name, get in getters}
+        for row in rows
+    ]
+
+
+def message_list(page_for):
+    """Respond with a page of messages from `page_for(before, per_page)`.
+
+    `page_for` returns (messages, next_cursor) for messages newest first,
+    as TimelineEntry.page_for does.
+    """
+
+    before = request.args.get('before')
+    if before:
+        before = decode_cursor(before, datetime, int)
+
+    fields = selected_fields(MESSAGE_FIELDS)
+
+    messages, next_cursor = page_for(
+        before, page_size(current_app.config['MESSAGES_PER_PAGE']))
+
+    context = {
+        'liked_ids': (
+            Like.liked_message_ids(g.user.id, [msg.id for msg in messages])
+            if 'liked' in fields else set()),
+    }
+
+    return json_response({
+        'data': serialize(messages, fields, MESSAGE_FIELDS, context),
+        'next_cursor': next_cursor,
+    })
+
+
+def user_list(users, next_cursor):
+    """Respond with a page of `users` (or rows with the same columns)."""
+
+    fields = selected_fields(USER_FIELDS)
+
+    context = {
+        'following_ids': (
+            g.user.following_status([user.id for user in users])
+            if 'following' in fields else set()),
+    }
+
+    return json_response({
+        'data': serialize(users, fields, USER_FIELDS, context),
+        'next_cursor': next_cursor,
+    })
+
+
+@api.before_request
+def require_login():
+    """Refuse API requests from anonymous users."""
+
+    if not g.user:
+        return json_response({'error': "Access unauthorized."}, 401)
+
+
+@api.errorhandler(HTTPException)
+def json_error(error):
+    """Report errors in API requests as JSON, rather than HTML pages."""
+
+    return json_response({'error': error.description}, error.code)
+
+
+@api.get('/timeline')
+def timeline():
+    """Messages on the current user's home timeline, newest first."""
+
+    return message_list(
+        lambda before, per_page: TimelineEntry.page_for(
+            g.user.id, per_page, before=before))
+
+
+@api.get('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """Messages written by a user, newest first."""
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+
+    return message_list(
+        lambda before, per_page: keyset_page(
+            Message.authored_by(user.id, before=before),
+            per_page,
+            key=lambda message: (message.timestamp, message.id),
+        ))
+
+
+@api.get('/users/<int:user_id>/following')
+def following(user_id):
+    """Users this user follows, by id."""
+
+    after = request.args.get('after')
+    if after:
+        (after,) = decode_cursor(after, int)
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    users, next_cursor = keyset_page(
+        User.following_of(user.id, after=after),
+        page_size(current_app.config['USERS_PER_PAGE']),
+        key=lambda followed: (followed.id,),
+    )
+
+    return user_list(users, next_cursor)
+
+
+@api.get('/users/<int:user_id>/followers')
+def followers(user_id):
+    """Users following this user, by id."""
+
+    after = request.args.get('after')
+    if after:
+        (after,) = decode_cursor(after, int)
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    users, next_cursor = keyset_page(
+        User.followers_of(user.id, after=after),
+        page_size(current_app.config['USERS_PER_PAGE']),
+        key=lambda follower: (follower.id,),
+    )
+
+    return user_list(users, next_cursor)
+
+
+@api.get('/users')
+def list_users():
+    """All users by id or, given 'q', users matching it, best matches first.
+    """
+
+    search = request.args.get('q')
+    after = request.args.get('after')
+    per_page = page_size(current_app.config['USERS_PER_PAGE'])
+
+    if not search:
+        query = User.cards().order_by(User.id)
+        if after:
+            (after_id,) = decode_cursor(after, int)
+            query = query.filter(User.id > after_id)
+
+        users, next_cursor = keyset_page(
+            query, per_page, key=lambda user: (user.id,))
+
+    else:
+        if after:
+            after = decode_cursor(after, int, str, int)
+
+        rows, next_cursor = User.search_page(search, per_page, after=after)
+        users = [row.User for row in rows]
+
+    return user_list(users, next_cursor)
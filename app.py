@@ -1,33 +1,103 @@
 import os
+import time
+from datetime import datetime
+from hashlib import sha1
+
+import click
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, url_for,
+    jsonify, make_response
+)
 from flask_debugtoolbar import DebugToolbarExtension
+from markupsafe import Markup
 from sqlalchemy.exc import IntegrityError
-from werkzeug.exceptions import Forbidden
+from werkzeug.exceptions import BadRequest, Forbidden, NotFound
 
 from forms import (
     UserAddForm, LoginForm, MessageForm, CSRFProtectForm, UserEditForm
 )
-from models import (db, connect_db, User, Message,
+from api import api
+from cache import init_cache_metrics, make_cache
+from deletion import request_deletion, run_worker
+from instrumentation import init_sql_instrumentation
+from migrations import explain_checks, upgrade
+from models import (db, connect_db, User, Message, Like, Follows,
+                    TimelineEntry, CurrentUser, AccountGone,
                     DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL)
+from pagination import decode_cursor, keyset_page
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
-
 app = Flask(__name__)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+app.config['MESSAGES_PER_PAGE'] = 100
+app.config['USERS_PER_PAGE'] = 48
+app.config['MAX_BULK_FOLLOW'] = 100
+# Shared cache server (redis://host:port/db); unset, caches are per process
+app.config['CACHE_URL'] = os.environ.get('CACHE_URL')
+app.config['USER_CACHE_SIZE'] = 1024
+app.config['USER_CACHE_TTL'] = 60
+app.config['FRAGMENT_CACHE_SIZE'] = 10000
+app.config['FRAGMENT_CACHE_TTL'] = 3600
+app.config['TIMELINE_CACHE_SIZE'] = 10000
+app.config['TIMELINE_CACHE_TTL'] = 30
+app.config['COUNTER_CACHE_SIZE'] = 10000
+app.config['COUNTER_CACHE_TTL'] = 60
+app.config['API_FAST_JSON'] = True
+app.config['TIMELINE_PULL_THRESHOLD'] = 10000
+app.config['SQL_SLOW_QUERY_MS'] = int(
+    os.environ.get('SQL_SLOW_QUERY_MS', 100))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_WORKERS'] = int(
+    os.environ.get('BCRYPT_WORKERS', os.cpu_count()))
 toolbar = DebugToolbarExtension(app)
 
 # To turn debug redirects off:
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
 connect_db(app)
+init_sql_instrumentation(app, db.engine)
+init_cache_metrics(app)
+app.register_blueprint(api)
+
+# Profile columns of recently seen logged in users, keyed by user id; see
+# add_user_to_g
+user_cache = make_cache(
+    app.config['CACHE_URL'], 'users',
+    maxsize=app.config['USER_CACHE_SIZE'],
+    ttl=app.config['USER_CACHE_TTL'],
+)
+
+# Rendered message cards, keyed by (message id, author's profile version);
+# see message_card. Always per process: a page shows up to a hundred cards,
+# too many round trips to a shared cache, and keys change with the cards.
+fragment_cache = make_cache(
+    None, 'fragments',
+    maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+    ttl=app.config['FRAGMENT_CACHE_TTL'],
+)
+
+# Ids on the first page of users' home timelines, keyed by (user id, page
+# size); see timeline_page
+timeline_cache = make_cache(
+    app.config['CACHE_URL'], 'timelines',
+    maxsize=app.config['TIMELINE_CACHE_SIZE'],
+    ttl=app.config['TIMELINE_CACHE_TTL'],
+)
+
+# Counter columns of users, keyed by user id; see user_counts
+counter_cache = make_cache(
+    app.config['CACHE_URL'], 'counters',
+    maxsize=app.config['COUNTER_CACHE_SIZE'],
+    ttl=app.config['COUNTER_CACHE_TTL'],
+)
 
 ##############################################################################
 # do login/logout functions
@@ -44,20 +114,269 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+
+def invalidate_user(user_id):
+    """Drop the cached profile of `user_id`; call after committing a change.
+
+    This covers all of the user's sessions. With a shared cache it covers
+    every worker too; otherwise other workers' copies expire within
+    USER_CACHE_TTL, so routes acting as the user check it's still active
+    (see require_active_user).
+    """
+
+    user_cache.delete(user_id)
+
+
+def require_active_user():
+    """Log out the current user if their account has been deleted.
+
+    g.user may come from a profile cached before the account was deleted in
+    another session or worker. Routes that act as the user call this before
+    changing anything. Returns whether a user is (still) logged in.
+    """
+
+    if g.user and not g.user.is_active():
+        invalidate_user(g.user.id)
+        do_logout()
+        g.user = None
+
+    return bool(g.user)
+
+
+def user_counts(user_id):
+    """Return the counters of `user_id` (see User.counts_of), cached."""
+
+    return counter_cache.get_or_set(
+        user_id, lambda: User.counts_of(user_id))
+
+
+def invalidate_counts(*user_ids):
+    """Drop the cached counters of `user_ids` after changing them.
+
+    Call after committing, so they can't be cached again from before the
+    change. Counters changed by the deletion worker are only refreshed when
+    their entries expire.
+    """
+
+    for user_id in user_ids:
+        counter_cache.delete(user_id)
+
+
+def timeline_page(user_id, before=None):
+    """Return (messages, next_cursor) for a page of `user_id`'s timeline.
+
+    The ids on the first page are cached, so showing it again takes a
+    single query. Anything that adds to or removes from the timeline
+    invalidates it (see invalidate_timelines), including messages fanned
+    out to it. Pages of users following pulled authors aren't cached, as
+    those authors' messages are merged in when the page is read.
+    """
+
+    per_page = app.config['MESSAGES_PER_PAGE']
+    cache_key = (user_id, per_page)
+
+    if before:
+        return TimelineEntry.page_for(user_id, per_page, before=before)
+
+    cached = timeline_cache.get(cache_key)
+
+    if cached is None:
+        messages, next_cursor = TimelineEntry.page_for(user_id, per_page)
+
+        if not TimelineEntry.follows_pulled_authors(user_id):
+            timeline_cache.set(
+                cache_key, ([msg.id for msg in messages], next_cursor))
+
+        return messages, next_cursor
+
+    message_ids, next_cursor = cached
+
+    # Messages deleted since they were cached, or whose authors deleted
+    # their account, are left out
+    loaded = Message.with_active_author().filter(Message.id.in_(message_ids))
+    messages = {msg.id: msg for msg in loaded}
+
+    return [messages[message_id] for message_id in message_ids
+            if message_id in messages], next_cursor
+
+
+def invalidate_timelines(*user_ids):
+    """Drop the cached first pages of `user_ids`' timelines; call after
+    committing a change to them.
+    """
+
+    per_page = app.config['MESSAGES_PER_PAGE']
+    timeline_cache.delete_many([(user_id, per_page) for user_id in user_ids])
+
+
+def wants_json():
+    """Does the client prefer a JSON response over an HTML page?"""
+
+    best = request.accept_mimetypes.best_match(
+        ['text/html', 'application/json'])
+    return best == 'application/json'
+
+
+def wants_fragment():
+    """Is this infinite scroll asking for just the next page's messages?"""
+
+    return request.headers.get('X-Fragment') == 'messages'
+
+
+def get_liked_message_ids(messages):
+    """Return ids of `messages` liked by the current user, in one query."""
+
+    return Like.liked_message_ids(g.user.id, [msg.id for msg in messages])
+
+
+def user_stamps(user):
+    """Return what's shown of `user` on their profile pages, for ETags."""
+
+    return (user.id, user.profile_version, user.messages_count,
+            user.following_count, user.followers_count, user.likes_count)
+
+
+def message_stamps(messages):
+    """Return what identifies the cards of `messages`, for ETags.
+
+    Messages can't be edited, so their id and their author's profile
+    version cover everything shown on a card.
+    """
+
+    return [(msg.id, msg.author.profile_version) for msg in messages]
+
+
+def page_etag(stamps):
+    """Return a weak ETag for a page whose content is given by `stamps`.
+
+    Pages also depend on the viewer (the navbar, forms' CSRF tokens), so
+    they're part of the ETag too. So is the window of time a page's CSRF
+    token stays valid in, so a cached copy's forms don't stop working.
+    """
+
+    time_limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    csrf_window = time_limit and int(time.time() // (time_limit / 2))
+    viewer = g.user and (g.user.id, g.user.profile_version)
+
+    validator = repr((viewer, session.get('csrf_token'), csrf_window, stamps))
+
+    return sha1(validator.encode()).hexdigest()
+
+
+def render_conditional(stamps, template, **context):
+    """Render `template`, unless the client's copy of it is still current.
+
+    `stamps` must change whenever the page would, besides changes of viewer
+    (see page_etag); they're computed from the data the route loads anyway,
+    so a matching If-None-Match gets a 304 without rendering the template.
+    """
+
+    etag = page_etag(stamps)
+
+    # Pending flash messages are shown on the next page that's rendered
+    if request.if_none_match.contains_weak(etag) and '_flashes' not in session:
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render_template(template, **context))
+
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+    return response
+
+
+def render_message_list(stamps, template, next_url, **context):
+    """Render a page listing messages, conditionally (see render_conditional).
+
+    Infinite scroll (static/js/infinite-scroll.js) fetches `next_url` with
+    an X-Fragment: messages header, and gets back only the list items, with
+    the URL of the page after that in an X-Next-Url header.
+    """
+
+    fragment = wants_fragment()
+
+    response = render_conditional(
+        (fragment, next_url, stamps),
+        'messages/items.html' if fragment else template,
+        next_url=next_url,
+        **context
+    )
+    response.vary.add('X-Fragment')
+
+    if fragment and next_url:
+        response.headers['X-Next-Url'] = next_url
+
+    return response
+
+
+@app.template_global()
+def message_card(message):
+    """Return the markup of a message's card that's the same for everyone.
+
+    That's the author's avatar and username, the text and the date; the like
+    button depends on the viewer and is rendered around it per request.
+    Cards are cached by message id and the author's profile version, so
+    editing or deleting a profile re-renders its author's cards.
+    """
+
+    key = (message.id, message.author.profile_version)
+    card = fragment_cache.get(key)
+
+    if card is None:
+        card = Markup(app.jinja_env.get_template('messages/card.html')
+                      .render(message=message))
+        fragment_cache.set(key, card)
+
+    return card
+
+
 ##############################################################################
 # User signup/login/logout routes
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a CurrentUser: if the user's profile is cached, it only queries
+    the database when something beyond the cached profile is used.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        user_id = session[CURR_USER_KEY]
+        profile = user_cache.get(user_id)
+
+        if profile:
+            g.user = CurrentUser(
+                user_id,
+                profile=profile,
+                counts=lambda: user_counts(user_id),
+            )
+            return
+
+        user = User.query.get(user_id)
+
+        if user and not user.deleted_at:
+            user_cache.set(user_id, CurrentUser.profile_of(user))
+            g.user = CurrentUser(user_id, user=user)
+        else:
+            g.user = None
 
     else:
         g.user = None
 
 
+@app.errorhandler(AccountGone)
+def account_gone(error):
+    """Log out a user whose account was purged while they were logged in."""
+
+    invalidate_user(error.user_id)
+    do_logout()
+    flash("Access unauthorized.", "danger")
+
+    return redirect("/")
+
+
 @app.before_request
 def add_crsf_form_to_g():
     """Add CSRFProtectForm to g object"""
@@ -74,6 +393,7 @@ def demo():
     )
 
     if user:
+        db.session.commit()
         do_login(user)
         flash(f"Hello, {user.username}!", "success")
         return redirect("/")
@@ -135,6 +455,8 @@ def login():
         )
 
         if user:
+            # Saves the password's new hash, if authenticate rehashed it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -168,7 +490,8 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and an
+    'after' cursor to show the next page of users.
     """
 
     if not g.user:
@@ -176,54 +499,143 @@ def list_users():
         return redirect("/")
 
     search = request.args.get('q')
+    after = request.args.get('after')
+    per_page = app.config['USERS_PER_PAGE']
 
     if not search:
-        users = User.query.all()
+        query = User.active().order_by(User.id)
+        if after:
+            (after_id,) = decode_cursor(after, int)
+            query = query.filter(User.id > after_id)
+
+        users, next_cursor = keyset_page(
+            query, per_page, key=lambda user: (user.id,))
+
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        if after:
+            after = decode_cursor(after, int, str, int)
 
-    return render_template('users/index.html', users=users)
+        rows, next_cursor = User.search_page(search, per_page, after=after)
+        users = [row.User for row in rows]
+
+    return render_template(
+        'users/index.html',
+        users=users,
+        following_ids=g.user.following_status([user.id for user in users]),
+        next_url=next_cursor and url_for(
+            'list_users', q=search, after=next_cursor)
+    )
 
 
 @app.get('/users/<int:user_id>')
 def show_user(user_id):
-    """Show user profile."""
+    """Show user profile and their messages, newest first, a page at a time.
+
+    Can take a 'before' cursor in querystring to show the next page.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    before = request.args.get('before')
+    if before:
+        before = decode_cursor(before, datetime, int)
 
-    return render_template(
+    user = User.active().filter_by(id=user_id).first_or_404()
+    messages, next_cursor = keyset_page(
+        Message.authored_by(user.id, before=before),
+        app.config['MESSAGES_PER_PAGE'],
+        key=lambda message: (message.timestamp, message.id),
+    )
+    liked_message_ids = get_liked_message_ids(messages)
+    follows_user = g.user.id != user.id and g.user.is_following(user)
+
+    return render_message_list(
+        (user_stamps(user), follows_user, message_stamps(messages),
+         sorted(liked_message_ids)),
         'users/show.html',
+        next_url=next_cursor and url_for(
+            'show_user', user_id=user.id, before=next_cursor),
         user=user,
-        messages=user.authored_messages
+        messages=messages,
+        liked_message_ids=liked_message_ids,
+        follows_user=follows_user
     )
 
 
 @app.get('/users/<int:user_id>/following')
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following, a page at a time.
+
+    Can take an 'after' cursor in querystring to show the next page.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    after = request.args.get('after')
+    if after:
+        (after,) = decode_cursor(after, int)
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    users, next_cursor = keyset_page(
+        User.following_of(user.id, after=after),
+        app.config['USERS_PER_PAGE'],
+        key=lambda followed: (followed.id,),
+    )
+    following_ids = g.user.following_status([card.id for card in users])
+    follows_user = g.user.id != user.id and g.user.is_following(user)
+
+    return render_conditional(
+        (user_stamps(user), follows_user, tuple(users),
+         sorted(following_ids), next_cursor),
+        'users/following.html',
+        user=user,
+        users=users,
+        following_ids=following_ids,
+        follows_user=follows_user,
+        next_url=next_cursor and url_for(
+            'show_following', user_id=user.id, after=next_cursor)
+    )
 
 
 @app.get('/users/<int:user_id>/followers')
 def show_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user, a page at a time.
+
+    Can take an 'after' cursor in querystring to show the next page.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    after = request.args.get('after')
+    if after:
+        (after,) = decode_cursor(after, int)
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    users, next_cursor = keyset_page(
+        User.followers_of(user.id, after=after),
+        app.config['USERS_PER_PAGE'],
+        key=lambda follower: (follower.id,),
+    )
+    following_ids = g.user.following_status([card.id for card in users])
+    follows_user = g.user.id != user.id and g.user.is_following(user)
+
+    return render_conditional(
+        (user_stamps(user), follows_user, tuple(users),
+         sorted(following_ids), next_cursor),
+        'users/followers.html',
+        user=user,
+        users=users,
+        following_ids=following_ids,
+        follows_user=follows_user,
+        next_url=next_cursor and url_for(
+            'show_followers', user_id=user.id, after=next_cursor)
+    )
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -233,17 +645,53 @@ def start_following(follow_id):
     Redirect to following page for the current for the current user.
     """
 
-    if not g.user or not g.csrf_form.validate_on_submit():
+    if (not g.user or not g.csrf_form.validate_on_submit()
+            or not require_active_user()):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    if not Follows.follow(g.user.id, [follow_id]):
+        # Nothing new to follow: 404 if that's because there's no such user
+        User.active().filter_by(id=follow_id).first_or_404()
+
     db.session.commit()
+    invalidate_counts(g.user.id, follow_id)
+    invalidate_timelines(g.user.id)
 
     return redirect(request.referrer)
 
 
+@app.post('/users/follow')
+def bulk_follow():
+    """Follow every user in the 'user_ids' form field, e.g. when onboarding.
+
+    Responds with JSON of the newly followed ids if the client asks for it,
+    else redirects to the following page for the current user.
+    """
+
+    if (not g.user or not g.csrf_form.validate_on_submit()
+            or not require_active_user()):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user_ids = request.form.getlist('user_ids', type=int)
+
+    if len(user_ids) > app.config['MAX_BULK_FOLLOW']:
+        raise BadRequest(
+            f"Can follow at most {app.config['MAX_BULK_FOLLOW']} users "
+            "at once.")
+
+    followed_ids = Follows.follow(g.user.id, user_ids)
+    db.session.commit()
+    invalidate_counts(g.user.id, *followed_ids)
+    invalidate_timelines(g.user.id)
+
+    if wants_json():
+        return jsonify(followed=followed_ids)
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
 @app.post('/users/stop-following/<int:follow_id>')
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user.
@@ -251,13 +699,15 @@ def stop_following(follow_id):
     Redirect to following page for the current for the current user.
     """
 
-    if not g.user or not g.csrf_form.validate_on_submit():
+    if (not g.user or not g.csrf_form.validate_on_submit()
+            or not require_active_user()):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    Follows.unfollow(g.user.id, follow_id)
     db.session.commit()
+    invalidate_counts(g.user.id, follow_id)
+    invalidate_timelines(g.user.id)
 
     return redirect(request.referrer)
 
@@ -282,8 +732,10 @@ def profile():
             g.user.header_image_url = (form.header_image_url.data or
                                        DEFAULT_HEADER_IMAGE_URL)
             g.user.bio = form.bio.data
+            User.bump_profile_version(g.user.id)
 
             db.session.commit()
+            invalidate_user(g.user.id)
 
             return redirect(f"/users/{g.user.id}")
 
@@ -297,37 +749,59 @@ def profile():
 
 @app.get("/users/<int:user_id>/liked-messages")
 def show_liked_messages(user_id):
-    """Show user like messages"""
+    """Show messages this user liked, most recently liked first.
+
+    Can take a 'before' cursor in querystring to show the next page.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    before = request.args.get('before')
+    if before:
+        before = decode_cursor(before, datetime, int)
 
-    return render_template(
+    user = User.active().filter_by(id=user_id).first_or_404()
+    rows, next_cursor = keyset_page(
+        Message.liked_by(user.id, before=before),
+        app.config['MESSAGES_PER_PAGE'],
+        key=lambda row: (row.liked_at, row.like_id),
+    )
+    messages = [row.Message for row in rows]
+    liked_message_ids = get_liked_message_ids(messages)
+    follows_user = g.user.id != user.id and g.user.is_following(user)
+
+    return render_message_list(
+        (user_stamps(user), follows_user, message_stamps(messages),
+         sorted(liked_message_ids)),
         'users/show.html',
+        next_url=next_cursor and url_for(
+            'show_liked_messages', user_id=user.id, before=next_cursor),
         user=user,
-        messages=user.liked_messages
+        messages=messages,
+        liked_message_ids=liked_message_ids,
+        follows_user=follows_user
     )
 
 @app.post('/users/delete')
 def delete_user():
     """Delete user.
 
-    Redirect to signup page.
+    The account is marked deleted right away and its data purged later by
+    the deletion worker (see deletion.py). Redirect to signup page.
     """
 
     if not g.user or not g.csrf_form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    do_logout()
-
-    Message.query.filter_by(user_id=g.user.id).delete()
-    db.session.delete(g.user)
+    request_deletion(g.user.id)
     db.session.commit()
 
+    invalidate_user(g.user.id)
+    do_logout()
+
     return redirect("/signup")
 
 
@@ -348,9 +822,19 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.authored_messages.append(msg)
+        if not require_active_user():
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        User.adjust_counts([g.user.id], messages_count=1)
+        timeline_user_ids = TimelineEntry.fan_out(
+            msg, pull_threshold=app.config['TIMELINE_PULL_THRESHOLD'])
         db.session.commit()
+        invalidate_counts(g.user.id)
+        invalidate_timelines(*timeline_user_ids)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -365,32 +849,58 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = (Message.with_active_author()
+           .filter(Message.id == message_id)
+           .first_or_404())
+    liked_message_ids = get_liked_message_ids([msg])
+    follows_author = (g.user.id != msg.user_id
+                      and g.user.is_following(msg.author))
+
+    return render_conditional(
+        (message_stamps([msg]), follows_author, sorted(liked_message_ids)),
+        'messages/show.html',
+        message=msg,
+        liked_message_ids=liked_message_ids,
+        follows_author=follows_author
+    )
 
 
 @app.post('/messages/<int:msg_id>/like')
 def like_message(msg_id):
-    """Toggle like/unlike message and redirect to origin page."""
+    """Toggle like/unlike message.
+
+    Responds with JSON of the new like state and count if the client asks
+    for it (as static/js/likes.js does), else redirects to origin page.
+    """
 
     form = g.csrf_form
 
-    if not form.validate_on_submit() or not g.user:
+    if (not form.validate_on_submit() or not g.user
+            or not require_active_user()):
+        if wants_json():
+            return jsonify(error="Access unauthorized."), 401
+
         flash("Access unauthorized.", "danger")
         print(form.errors)
         return redirect("/")
 
-    msg = Message.query.get_or_404(msg_id)
+    result = Like.toggle(g.user.id, msg_id)
 
-    if msg.user_id == g.user.id:
-        raise Forbidden
+    if result.author_id is None:
+        raise NotFound
 
-    if msg in g.user.liked_messages:
-        g.user.liked_messages.remove(msg)
-    else:
-        g.user.liked_messages.append(msg)
+    if result.author_id == g.user.id:
+        raise Forbidden
 
     db.session.commit()
+    invalidate_counts(g.user.id)
+
+    if wants_json():
+        return jsonify(
+            message_id=msg_id,
+            liked=result.liked,
+            like_count=result.like_count
+        )
 
     return redirect(request.referrer)
     # TODO: request.referrer May not be supported by all browsers,
@@ -409,10 +919,19 @@ def delete_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
+    msg = Message.with_author().get_or_404(message_id)
+    card_key = (msg.id, msg.author.profile_version)
+    author_id = msg.user_id
+
+    liker_ids = User.uncount_likes_of(Message.id == msg.id)
+    User.adjust_counts([msg.user_id], messages_count=-1)
     db.session.delete(msg)
     db.session.commit()
 
+    fragment_cache.delete(card_key)
+    invalidate_counts(author_id, *liker_ids)
+    invalidate_timelines(author_id)
+
     return redirect(f"/users/{g.user.id}")
 
 
@@ -425,25 +944,127 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of current user and the users
-      they follow
+    - logged in: most recent messages of current user and the users
+      they follow, a page at a time
+
+    Can take a 'before' cursor in querystring to show the next page.
     """
 
     if g.user:
-        following_ids = [user.id for user in g.user.following]+[g.user.id]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        before = request.args.get('before')
+        if before:
+            before = decode_cursor(before, datetime, int)
+
+        messages, next_cursor = timeline_page(g.user.id, before=before)
 
-        return render_template('home.html', messages=messages)
+        liked_message_ids = get_liked_message_ids(messages)
+
+        return render_message_list(
+            (user_stamps(g.user), message_stamps(messages),
+             sorted(liked_message_ids)),
+            'home.html',
+            next_url=next_cursor and url_for('homepage', before=next_cursor),
+            messages=messages,
+            liked_message_ids=liked_message_ids
+        )
 
     else:
         return render_template('home-anon.html')
 
 
+##############################################################################
+# Command line maintenance tasks
+
+
+@app.cli.command("db-upgrade")
+def db_upgrade():
+    """Apply pending schema migrations (see migrations.py)."""
+
+    applied = upgrade(db.engine)
+    print(f"Applied {len(applied)} migration(s).")
+
+
+@app.cli.command("db-explain")
+def db_explain():
+    """Check that the hot queries can use their indexes."""
+
+    results = explain_checks(db.session)
+
+    for name, index, used in results:
+        print(f"{'ok' if used else 'MISSING':>7}  {name} ({index})")
+
+    if not all(used for name, index, used in results):
+        raise SystemExit(1)
+
+
+@app.cli.command("rebuild-timelines")
+def rebuild_timelines():
+    """Rebuild every user's home timeline from follows and messages.
+
+    Each user is rebuilt and committed separately, so the homepage keeps
+    serving the existing entries while this runs.
+    """
+
+    user_ids = db.session.scalars(db.select(User.id).order_by(User.id)).all()
+
+    for user_id in user_ids:
+        TimelineEntry.rebuild(user_id)
+        db.session.commit()
+
+    print(f"Rebuilt timelines for {len(user_ids)} users.")
+
+
+@app.cli.command("rebalance-timelines")
+def rebalance_timelines():
+    """Switch authors between fanned out and pulled timeline messages.
+
+    Authors are switched to pulled as soon as they post with
+    TIMELINE_PULL_THRESHOLD followers; this catches up those who haven't
+    posted since, and switches back those who've fallen below half the
+    threshold (the gap stops authors near it from flipping back and forth).
+    """
+
+    threshold = app.config['TIMELINE_PULL_THRESHOLD']
+
+    pulled = TimelineEntry.pull_popular_authors(threshold)
+    db.session.commit()
+
+    author_ids = db.session.scalars(
+        db.select(User.id).where(
+            User.timeline_pull,
+            User.followers_count < threshold // 2,
+        )
+    ).all()
+
+    for author_id in author_ids:
+        TimelineEntry.push_author(author_id)
+        db.session.commit()
+
+    print(f"Switched {pulled} author(s) to pulled and "
+          f"{len(author_ids)} back to fanned out.")
+
+
+@app.cli.command("run-deletions")
+@click.option("--batch-size", default=1000, show_default=True,
+              help="Rows deleted per transaction.")
+@click.option("--once", is_flag=True,
+              help="Exit when no deletions are queued instead of polling.")
+def run_deletions(batch_size, once):
+    """Purge the data of deleted accounts in the background."""
+
+    run_worker(batch_size=batch_size, once=once)
+
+
+@app.cli.command("reconcile-counters")
+def reconcile_counters():
+    """Recompute every user's message/follow/like counters."""
+
+    User.reconcile_counts()
+    db.session.commit()
+
+    print("Reconciled user counters.")
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -453,8 +1074,13 @@ def homepage():
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Don't let responses be stored, unless their route set a policy.
+
+    Pages served with render_conditional can be stored but must be
+    revalidated; static files keep Flask's own policy.
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if not response.cache_control:
+        response.cache_control.no_store = True
     return response
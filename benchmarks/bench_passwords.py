@@ -0,0 +1,69 @@
+"""Benchmark password hashing throughput and login latency.
+
+Simulates bursts of logins (one bcrypt check each) from many request
+threads against hashing pools of different sizes, and reports hashes per
+second and p50/p99 login latency for each pool size and work factor.
+
+Run from the project root:
+
+    python -m benchmarks.bench_passwords --rounds 10 12 --workers 1 2 4 8
+"""
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from statistics import quantiles
+from time import perf_counter
+
+from passwords import PooledBcrypt
+
+
+def run_burst(bcrypt, pw_hash, logins, request_threads):
+    """Check `logins` passwords from `request_threads` concurrent threads.
+
+    Returns (elapsed seconds, list of per-login latencies in seconds).
+    """
+
+    def login(_):
+        start = perf_counter()
+        bcrypt.check_password_hash(pw_hash, "password")
+        return perf_counter() - start
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=request_threads) as requests:
+        latencies = list(requests.map(login, range(logins)))
+
+    return perf_counter() - start, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rounds", type=int, nargs="+", default=[10, 12])
+    parser.add_argument(
+        "--workers", type=int, nargs="+",
+        default=sorted({1, 2, 4, os.cpu_count()}))
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--request-threads", type=int, default=32)
+    args = parser.parse_args()
+
+    print(f"{'rounds':>6} {'workers':>7} {'hashes/s':>9} "
+          f"{'p50 ms':>8} {'p99 ms':>8}")
+
+    for rounds in args.rounds:
+        bcrypt = PooledBcrypt()
+        bcrypt.set_log_rounds(rounds)
+        pw_hash = bcrypt.generate_password_hash("password")
+
+        for workers in args.workers:
+            bcrypt.set_workers(workers)
+            elapsed, latencies = run_burst(
+                bcrypt, pw_hash, args.logins, args.request_threads)
+
+            cuts = quantiles(latencies, n=100)
+            print(f"{rounds:>6} {workers:>7} "
+                  f"{args.logins / elapsed:>9.1f} "
+                  f"{cuts[49] * 1000:>8.1f} {cuts[98] * 1000:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
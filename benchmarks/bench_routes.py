@@ -0,0 +1,342 @@
+"""Benchmark Warbler's main routes against a large dataset.
+
+Drives the home timeline, profiles, the user list and search, liked
+messages, following and liking through the Flask test client, as randomly
+chosen logged-in users, and reports throughput, p50/p95/p99 latency and SQL
+statements per request for each scenario. The api_* scenarios fetch the
+same lists from the JSON API, for comparison with their HTML pages;
+--no-fast-json serializes them with the json module instead of orjson.
+
+Results can be saved as a baseline and later runs compared against it;
+the run fails (exit status 1) if a scenario got slower, or issued more
+statements per request, by more than --threshold.
+
+Run from the project root against a database you don't mind reseeding:
+
+    DATABASE_URL=postgresql:///warbler_bench \\
+        python -m benchmarks.bench_routes --generate --users 100000 \\
+        --messages 1000000 --save-baseline benchmarks/baseline.json
+
+    DATABASE_URL=postgresql:///warbler_bench \\
+        python -m benchmarks.bench_routes --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import json
+import logging
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from random import Random
+from statistics import quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from sqlalchemy import func, select
+
+from app import app, CURR_USER_KEY
+from instrumentation import endpoint_stats, reset_endpoint_stats
+from models import db, Message, User
+
+# Candidate ids drawn when picking users and messages to request
+SAMPLE_SIZE = 2000
+
+
+class Picker:
+    """Random choice of existing users and messages, for a given seed."""
+
+    def __init__(self, seed):
+        self.rng = Random(seed)
+
+        max_user_id, max_message_id = db.session.execute(
+            select(select(func.max(User.id)).scalar_subquery(),
+                   select(func.max(Message.id)).scalar_subquery())
+        ).one()
+
+        self.user_ids = db.session.scalars(
+            select(User.id).where(
+                User.deleted_at.is_(None),
+                User.id.in_(self.sample(max_user_id)))
+        ).all()
+
+        self.messages = db.session.execute(
+            select(Message.id, Message.user_id)
+            .where(Message.id.in_(self.sample(max_message_id)))
+        ).all()
+
+        self.usernames = db.session.scalars(
+            select(User.username).where(User.id.in_(self.user_ids[:100]))
+        ).all()
+
+        if not (self.user_ids and self.messages):
+            sys.exit("No users or messages to benchmark with; "
+                     "seed the database (see --generate).")
+
+    def sample(self, max_id):
+        return [self.rng.randint(1, max_id or 1) for _ in range(SAMPLE_SIZE)]
+
+    def user(self):
+        return self.rng.choice(self.user_ids)
+
+    def other_user(self, user_id):
+        while True:
+            other_id = self.user()
+            if other_id != user_id or len(self.user_ids) == 1:
+                return other_id
+
+    def message_not_by(self, user_id):
+        for attempt in range(10):
+            message_id, author_id = self.rng.choice(self.messages)
+            if author_id != user_id:
+                break
+
+        return message_id
+
+    def search_term(self):
+        return self.rng.choice(self.usernames)[:3]
+
+
+# Each scenario returns the requests one iteration makes as the viewer:
+# (method, path, extra test client arguments)
+
+def homepage(pick, viewer_id):
+    return [("GET", "/", {})]
+
+
+def show_user(pick, viewer_id):
+    return [("GET", f"/users/{pick.user()}", {})]
+
+
+def list_users(pick, viewer_id):
+    return [("GET", "/users", {})]
+
+
+def search_users(pick, viewer_id):
+    return [("GET", "/users", {"query_string": {"q": pick.search_term()}})]
+
+
+def show_liked_messages(pick, viewer_id):
+    return [("GET", f"/users/{pick.user()}/liked-messages", {})]
+
+
+def api_timeline(pick, viewer_id):
+    return [("GET", "/api/v1/timeline", {})]
+
+
+def api_user_messages(pick, viewer_id):
+    return [("GET", f"/api/v1/users/{pick.user()}/messages", {})]
+
+
+def api_followers(pick, viewer_id):
+    return [("GET", f"/api/v1/users/{pick.user()}/followers", {})]
+
+
+def api_search_users(pick, viewer_id):
+    return [("GET", "/api/v1/users",
+             {"query_string": {"q": pick.search_term()}})]
+
+
+def follow(pick, viewer_id):
+    """Follow and unfollow someone, leaving the data as it was."""
+
+    user_id = pick.other_user(viewer_id)
+
+    return [
+        ("POST", f"/users/follow/{user_id}", {}),
+        ("POST", f"/users/stop-following/{user_id}", {}),
+    ]
+
+
+def like(pick, viewer_id):
+    """Like and unlike a message, leaving the data as it was."""
+
+    message_id = pick.message_not_by(viewer_id)
+    json_request = {"headers": {"Accept": "application/json"}}
+
+    return [
+        ("POST", f"/messages/{message_id}/like", json_request),
+        ("POST", f"/messages/{message_id}/like", json_request),
+    ]
+
+
+SCENARIOS = {
+    scenario.__name__: scenario
+    for scenario in [homepage, show_user, list_users, search_users,
+                     show_liked_messages, follow, like, api_timeline,
+                     api_user_messages, api_followers, api_search_users]
+}
+
+
+def run_iteration(client, pick, scenario):
+    """Run one iteration of `scenario` as a random user.
+
+    Returns (list of latencies in seconds, number of failed requests).
+    """
+
+    viewer_id = pick.user()
+
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = viewer_id
+
+    latencies = []
+    errors = 0
+
+    for method, path, kwargs in scenario(pick, viewer_id):
+        start = perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        latencies.append(perf_counter() - start)
+
+        if response.status_code >= 400:
+            errors += 1
+
+    return latencies, errors
+
+
+def run_scenario(name, iterations, warmup, concurrency, seed):
+    """Run scenario `name`; return a dict of its results."""
+
+    scenario = SCENARIOS[name]
+
+    with app.app_context():
+        pick = Picker(f"{seed}:{name}")
+
+    def worker(iterations):
+        # Each thread gets its own client (cookies) and app context
+        with app.app_context():
+            client = app.test_client()
+            return [run_iteration(client, pick, scenario)
+                    for _ in range(iterations)]
+
+    worker(warmup)
+    reset_endpoint_stats()
+
+    per_worker = [iterations // concurrency] * concurrency
+    per_worker[0] += iterations % concurrency
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = [result
+                   for results in executor.map(worker, per_worker)
+                   for result in results]
+    elapsed = perf_counter() - start
+
+    latencies = [latency for times, errors in results for latency in times]
+    stats = endpoint_stats().values()
+    cuts = (quantiles(latencies, n=100) if len(latencies) > 1
+            else latencies * 99)
+
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors for times, errors in results),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": cuts[49] * 1000,
+        "p95_ms": cuts[94] * 1000,
+        "p99_ms": cuts[98] * 1000,
+        "statements": (sum(totals["statements"] for totals in stats)
+                       / max(sum(totals["requests"] for totals in stats), 1)),
+    }
+
+
+def regressions(results, baseline, threshold):
+    """Return descriptions of results worse than `baseline` by `threshold`."""
+
+    found = []
+
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+
+        if result["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            found.append(f"{name}: p95 {base['p95_ms']:.1f}ms -> "
+                         f"{result['p95_ms']:.1f}ms")
+
+        if result["rps"] < base["rps"] * (1 - threshold):
+            found.append(f"{name}: throughput {base['rps']:.1f}/s -> "
+                         f"{result['rps']:.1f}/s")
+
+        if result["statements"] > base["statements"] * (1 + threshold):
+            found.append(f"{name}: SQL statements/request "
+                         f"{base['statements']:.2f} -> "
+                         f"{result['statements']:.2f}")
+
+    return found
+
+
+def generate_data(args):
+    """Generate a dataset and load it into the app's database."""
+
+    with TemporaryDirectory() as data_dir:
+        subprocess.run([
+            sys.executable, "generator/generate_dataset.py",
+            "--out", data_dir,
+            "--seed", str(args.seed),
+            "--users", str(args.users),
+            "--messages", str(args.messages),
+        ], check=True)
+        subprocess.run(
+            [sys.executable, "seed.py", "--data-dir", data_dir], check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--generate", action="store_true",
+        help="reseed the database with a generated dataset first")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument(
+        "--no-fast-json", action="store_true",
+        help="serialize API responses with the json module, not orjson")
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2,
+        help="allowed fractional regression against the baseline")
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_data(args)
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG_TB_ENABLED'] = False
+    app.config['API_FAST_JSON'] = not args.no_fast_json
+    logging.getLogger("warbler.sql").setLevel(logging.ERROR)
+
+    print(f"{'scenario':<20} {'requests':>8} {'errors':>6} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'sql/req':>7}")
+
+    results = {}
+    for name in args.scenarios:
+        result = results[name] = run_scenario(
+            name, args.iterations, args.warmup, args.concurrency, args.seed)
+
+        print(f"{name:<20} {result['requests']:>8} {result['errors']:>6} "
+              f"{result['rps']:>8.1f} {result['p50_ms']:>8.1f} "
+              f"{result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f} "
+              f"{result['statements']:>7.1f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            found = regressions(
+                results, json.load(baseline_file), args.threshold)
+
+        for regression in found:
+            print(f"REGRESSION {regression}")
+
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""Benchmark home timeline writes and reads, fanned out vs hybrid.
+
+For each follower-count distribution (the Zipf exponent --skew: higher
+means a few authors have most of the followers), builds a follow graph,
+then posts messages as authors chosen the same way and reads the first
+page of random followers' timelines, once with every author fanned out
+and once with authors of --threshold or more followers pulled at read
+time. Reports per post the timeline entries written and fan-out latency,
+and per read the latency of TimelineEntry.page_for.
+
+Everything happens in one transaction that's rolled back, so any database
+will do:
+
+    DATABASE_URL=postgresql:///warbler_bench \\
+        python -m benchmarks.bench_timeline --skew 0.5 1.0 1.5
+"""
+
+import argparse
+from random import Random
+from statistics import quantiles
+from time import perf_counter
+
+from sqlalchemy import func, insert, select
+
+from app import app
+from models import db, Follows, Message, TimelineEntry, User
+
+
+def popularity_weights(authors, skew):
+    """Weights for picking authors 0..authors-1: rank r ~ 1 / r**skew."""
+
+    return [1 / rank ** skew for rank in range(1, authors + 1)]
+
+
+def build_graph(rng, args, skew):
+    """Insert authors and their followers.
+
+    Authors get their followers_count set, as fan-out reads it. Returns
+    (author ids, follower ids, most followers of any author).
+    """
+
+    weights = popularity_weights(args.authors, skew)
+    follows = [
+        set(rng.choices(range(args.authors), weights,
+                        k=args.follows_per_user))
+        for _ in range(args.followers)
+    ]
+
+    followers_count = [0] * args.authors
+    for followed in follows:
+        for author in followed:
+            followers_count[author] += 1
+
+    prefix = f"tlbench{skew}_"
+    db.session.execute(insert(User), [
+        {"username": f"{prefix}a{i}", "email": f"{prefix}a{i}@bench",
+         "password": "-", "followers_count": followers_count[i]}
+        for i in range(args.authors)
+    ] + [
+        {"username": f"{prefix}f{i}", "email": f"{prefix}f{i}@bench",
+         "password": "-"}
+        for i in range(args.followers)
+    ])
+
+    ids = dict(db.session.execute(
+        select(User.username, User.id)
+        .where(User.username.startswith(prefix))).all())
+    author_ids = [ids[f"{prefix}a{i}"] for i in range(args.authors)]
+    follower_ids = [ids[f"{prefix}f{i}"] for i in range(args.followers)]
+
+    db.session.execute(insert(Follows), [
+        {"user_being_followed_id": author_ids[author],
+         "user_following_id": follower_ids[i]}
+        for i, followed in enumerate(follows)
+        for author in followed
+    ])
+
+    return author_ids, follower_ids, max(followers_count)
+
+
+def run_mode(rng, args, skew, author_ids, follower_ids, threshold):
+    """Post and read timelines; roll back to where we started after."""
+
+    savepoint = db.session.begin_nested()
+
+    if threshold:
+        TimelineEntry.pull_popular_authors(threshold)
+
+    weights = popularity_weights(args.authors, skew)
+    post_times = []
+    message_ids = []
+
+    for author_id in rng.choices(author_ids, weights, k=args.posts):
+        msg = Message(text="bench", user_id=author_id)
+        db.session.add(msg)
+        db.session.flush()
+
+        start = perf_counter()
+        TimelineEntry.fan_out(msg, pull_threshold=threshold)
+        post_times.append(perf_counter() - start)
+        message_ids.append(msg.id)
+
+    entries = db.session.scalar(
+        select(func.count())
+        .select_from(TimelineEntry)
+        .where(TimelineEntry.message_id.in_(message_ids)))
+
+    read_times = []
+    for reader_id in rng.choices(follower_ids, k=args.reads):
+        start = perf_counter()
+        TimelineEntry.page_for(reader_id, args.per_page)
+        read_times.append(perf_counter() - start)
+
+    savepoint.rollback()
+
+    return {
+        "entries_per_post": entries / args.posts,
+        "post_p50_ms": quantiles(post_times, n=100)[49] * 1000,
+        "post_p99_ms": quantiles(post_times, n=100)[98] * 1000,
+        "read_p50_ms": quantiles(read_times, n=100)[49] * 1000,
+        "read_p99_ms": quantiles(read_times, n=100)[98] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--skew", type=float, nargs="+",
+                        default=[0.5, 1.0, 1.5])
+    parser.add_argument("--authors", type=int, default=500)
+    parser.add_argument("--followers", type=int, default=5000)
+    parser.add_argument("--follows-per-user", type=int, default=20)
+    parser.add_argument("--threshold", type=int, default=500)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--reads", type=int, default=300)
+    parser.add_argument("--per-page", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'skew':>5} {'max fol':>8} {'mode':<8} {'entries/post':>12} "
+          f"{'post p50':>9} {'post p99':>9} {'read p50':>9} {'read p99':>9}")
+
+    with app.app_context():
+        try:
+            for skew in args.skew:
+                rng = Random(f"{args.seed}:{skew}")
+                author_ids, follower_ids, max_followers = build_graph(
+                    rng, args, skew)
+
+                for mode, threshold in [("fan-out", None),
+                                        ("hybrid", args.threshold)]:
+                    result = run_mode(Random(f"{args.seed}:{skew}:posts"),
+                                      args, skew, author_ids, follower_ids,
+                                      threshold)
+
+                    print(f"{skew:>5} {max_followers:>8} {mode:<8} "
+                          f"{result['entries_per_post']:>12.1f} "
+                          f"{result['post_p50_ms']:>7.2f}ms "
+                          f"{result['post_p99_ms']:>7.2f}ms "
+                          f"{result['read_p50_ms']:>7.2f}ms "
+                          f"{result['read_p99_ms']:>7.2f}ms")
+        finally:
+            db.session.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,506 @@
+"""Caching for Warbler.
+
+Every cache has the same interface: `get`, `set`, `delete`, `clear`,
+`get_or_set` and `metrics`. There are two backends:
+
+- LRUCache keeps entries in the process, so each gunicorn worker has its
+  own copy; right for data whose keys change when it does.
+- RedisCache keeps them on a server speaking the Redis protocol, shared by
+  every worker, so deleting an entry invalidates it everywhere.
+
+`make_cache` picks the backend from a URL (the CACHE_URL setting).
+
+`get_or_set` computes a missing value once however many callers miss it at
+the same time (single flight): the others wait for the first caller's
+result, instead of all querying the database for it at once.
+
+`init_cache_metrics` logs every cache's metrics from each process now and
+then.
+"""
+
+import json
+import logging
+import os
+import pickle
+import socket
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+
+logger = logging.getLogger("warbler.cache")
+
+# Returned by backends' _get for keys that aren't cached, as None may be
+MISSING = object()
+
+_caches = {}
+
+
+class CacheStats:
+    """Running counts of what happened in one cache, safe across threads.
+
+    hits/misses: lookups that did/didn't find a value
+    sets: values stored
+    evictions: entries dropped to make room for others
+    expirations: entries found past their ttl and dropped
+    waits: `get_or_set` misses served by another caller's computation
+    errors: failed requests to a shared cache's server
+    """
+
+    FIELDS = (
+        'hits', 'misses', 'sets', 'evictions', 'expirations', 'waits',
+        'errors',
+    )
+
+    def __init__(self):
+        self._counts = dict.fromkeys(self.FIELDS, 0)
+        self._lock = Lock()
+
+    def incr(self, field, amount=1):
+        with self._lock:
+            self._counts[field] += amount
+
+    def snapshot(self):
+        """Return a copy of the counts, and the hit rate of lookups."""
+
+        with self._lock:
+            counts = dict(self._counts)
+
+        lookups = counts['hits'] + counts['misses']
+        counts['hit_rate'] = counts['hits'] / lookups if lookups else 0.0
+
+        return counts
+
+
+class Cache:
+    """Base of the cache backends: stats, and single flight `get_or_set`.
+
+    Backends implement `_get` (returning MISSING for a miss), `set`,
+    `delete`, `delete_many` and `clear`.
+    """
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._flights = {}
+        self._flights_lock = Lock()
+
+    def get(self, key, default=None):
+        """Return the value for `key`, or `default` if missing or expired."""
+
+        value = self._get(key)
+
+        if value is MISSING:
+            self.stats.incr('misses')
+            return default
+
+        self.stats.incr('hits')
+        return value
+
+    def get_or_set(self, key, compute, ttl=None):
+        """Return the value for `key`, storing `compute()` if it's missing.
+
+        Concurrent misses of the same key in this process call `compute`
+        once; the other callers get its result.
+        """
+
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return value
+
+        with self._single_flight(key):
+            # Filled in while we waited for the caller computing it?
+            value = self._get(key)
+            if value is not MISSING:
+                self.stats.incr('waits')
+                return value
+
+            return self._compute(key, compute, ttl)
+
+    def metrics(self):
+        """Return this cache's stats (see CacheStats)."""
+
+        return self.stats.snapshot()
+
+    def _compute(self, key, compute, ttl):
+        value = compute()
+        self.set(key, value, ttl)
+
+        return value
+
+    @contextmanager
+    def _single_flight(self, key):
+        """Hold the lock for computing `key`, shared by callers missing it.
+        """
+
+        with self._flights_lock:
+            lock, callers = self._flights.get(key, (None, 0))
+            lock = lock or Lock()
+            self._flights[key] = (lock, callers + 1)
+
+        try:
+            with lock:
+                yield
+        finally:
+            with self._flights_lock:
+                lock, callers = self._flights[key]
+                if callers == 1:
+                    del self._flights[key]
+                else:
+                    self._flights[key] = (lock, callers - 1)
+
+
+class LRUCache(Cache):
+    """Process-local cache of at most `maxsize` entries.
+
+    The least recently used entry is evicted when the cache is full, and
+    entries expire `ttl` seconds after they were set.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, name='local'):
+        super().__init__(name, ttl)
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return MISSING
+
+            value, expires_at = entry
+            if expires_at <= monotonic():
+                del self._entries[key]
+                self.stats.incr('expirations')
+                return MISSING
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key`, evicting the oldest entry if full."""
+
+        with self._lock:
+            self._entries[key] = (value, monotonic() + (ttl or self.ttl))
+            self._entries.move_to_end(key)
+
+            evicted = 0
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                evicted += 1
+
+        self.stats.incr('sets')
+        if evicted:
+            self.stats.incr('evictions', evicted)
+
+    def delete(self, key):
+        """Remove `key` from the cache, if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_many(self, keys):
+        """Remove each of `keys` from the cache, if present."""
+
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisError(Exception):
+    """An error reply from a Redis protocol server."""
+
+
+class RESPConnection:
+    """Connection to a server speaking the Redis protocol (RESP2)."""
+
+    def __init__(self, address, timeout):
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.reader = self.sock.makefile('rb')
+
+    def command(self, *args):
+        """Send a command and return its reply."""
+
+        self.sock.sendall(self.encode(args))
+        return self.read_reply()
+
+    @staticmethod
+    def encode(args):
+        parts = [b'*%d\r\n' % len(args)]
+
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode()
+            elif isinstance(arg, int):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+
+        return b''.join(parts)
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("connection closed by server")
+
+        kind, rest = line[:1], line[1:-2]
+
+        if kind == b'+':
+            return rest.decode()
+        if kind == b'-':
+            raise RedisError(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            return None if length < 0 else self.reader.read(length + 2)[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self.read_reply() for _ in range(length)]
+
+        raise RedisError(f"unexpected reply {line!r}")
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+class RedisCache(Cache):
+    """Cache shared by every process, on a Redis protocol server at `url`.
+
+    `url` is redis://[:password@]host[:port][/db]. Keys are namespaced by
+    the cache's name; values are pickled, so the server must only be
+    writable by the app. If the server can't be reached the cache acts as
+    empty (and counts errors) rather than failing requests.
+
+    Single flight covers every process: the caller computing a missing key
+    holds a lock key on the server for up to `lock_timeout` seconds, which
+    callers in other processes wait on.
+    """
+
+    def __init__(self, url, name='cache', ttl=60, timeout=1.0,
+                 lock_timeout=5.0, poll_interval=0.01):
+        super().__init__(name, ttl)
+
+        parts = urlsplit(url)
+        self.address = (parts.hostname or 'localhost', parts.port or 6379)
+        self.password = parts.password
+        self.database = int(parts.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+
+        self._pool = []
+        self._pool_lock = Lock()
+
+    def _key(self, key):
+        return f"warbler:{self.name}:{key!r}"
+
+    @contextmanager
+    def _connection(self):
+        """Lend a pooled connection; it's closed if the command fails."""
+
+        with self._pool_lock:
+            conn = self._pool.pop() if self._pool else None
+
+        if conn is None:
+            conn = RESPConnection(self.address, self.timeout)
+            try:
+                if self.password:
+                    conn.command('AUTH', self.password)
+                if self.database:
+                    conn.command('SELECT', self.database)
+            except Exception:
+                conn.close()
+                raise
+
+        try:
+            yield conn
+        except (OSError, RedisError):
+            conn.close()
+            raise
+        else:
+            with self._pool_lock:
+                self._pool.append(conn)
+
+    def _command(self, *args, default=None):
+        """Run a command; on failure, log it and return `default`."""
+
+        try:
+            with self._connection() as conn:
+                return conn.command(*args)
+        except (OSError, RedisError) as error:
+            self.stats.incr('errors')
+            logger.warning(
+                "cache %s: %s failed: %s", self.name, args[0], error)
+            return default
+
+    def _get(self, key):
+        data = self._command('GET', self._key(key))
+
+        return MISSING if data is None else pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key` for `ttl` (default: the cache's) seconds.
+        """
+
+        self._command(
+            'SET', self._key(key), pickle.dumps(value),
+            'PX', int((ttl or self.ttl) * 1000))
+        self.stats.incr('sets')
+
+    def delete(self, key):
+        """Remove `key` from the cache, for every process."""
+
+        self._command('DEL', self._key(key))
+
+    def delete_many(self, keys, batch_size=1000):
+        """Remove each of `keys` from the cache, for every process.
+
+        Keys are deleted `batch_size` at a time, one round trip per batch.
+        """
+
+        keys = [self._key(key) for key in keys]
+
+        for start in range(0, len(keys), batch_size):
+            self._command('DEL', *keys[start:start + batch_size])
+
+    def clear(self):
+        """Remove every entry of this cache (not other caches on the server).
+        """
+
+        cursor = b'0'
+        while True:
+            reply = self._command(
+                'SCAN', cursor, 'MATCH', f"warbler:{self.name}:*",
+                'COUNT', 1000)
+            if reply is None:
+                return
+
+            cursor, keys = reply
+            if keys:
+                self._command('DEL', *keys)
+            if cursor == b'0':
+                return
+
+    def metrics(self):
+        """Return this cache's stats, and evictions counted by the server.
+
+        Redis evicts keys itself when it's out of memory; its count covers
+        every cache on the server.
+        """
+
+        metrics = super().metrics()
+        info = self._command('INFO', 'stats', default=b'')
+
+        for line in info.decode().splitlines():
+            name, _, value = line.partition(':')
+            if name == 'evicted_keys':
+                metrics['server_evictions'] = int(value)
+
+        return metrics
+
+    def _compute(self, key, compute, ttl):
+        lock_key = self._key(key) + ':lock'
+        token = os.urandom(8).hex()
+        deadline = monotonic() + self.lock_timeout
+
+        def try_lock():
+            # "OK" if locked, None if someone else holds it, else MISSING
+            return self._command(
+                'SET', lock_key, token, 'NX',
+                'PX', int(self.lock_timeout * 1000),
+                default=MISSING)
+
+        locked = try_lock()
+
+        # Another process is computing it: wait for its value, unless it
+        # takes too long (e.g. it died) or the server becomes unreachable
+        while locked is None and monotonic() < deadline:
+            sleep(self.poll_interval)
+
+            value = self._get(key)
+            if value is not MISSING:
+                self.stats.incr('waits')
+                return value
+
+            locked = try_lock()
+
+        try:
+            return super()._compute(key, compute, ttl)
+        finally:
+            if locked == 'OK':
+                self._command('DEL', lock_key)
+
+
+def make_cache(url, name, maxsize=1024, ttl=60):
+    """Return a cache named `name`: shared on the server at `url` if given,
+    else process-local. Its metrics are included in `cache_metrics()`.
+    """
+
+    if not url:
+        cache = LRUCache(maxsize=maxsize, ttl=ttl, name=name)
+    elif urlsplit(url).scheme == 'redis':
+        cache = RedisCache(url, name=name, ttl=ttl)
+    else:
+        raise ValueError(f"Unsupported cache URL: {url}")
+
+    _caches[name] = cache
+    return cache
+
+
+def cache_metrics():
+    """Return the metrics of every cache made by `make_cache`, by name."""
+
+    return {name: cache.metrics() for name, cache in _caches.items()}
+
+
+def init_cache_metrics(app):
+    """Log `cache_metrics()` as a structured line from `app`'s requests.
+
+    Stats are kept per process, so each process logs its own, at most once
+    per interval.
+
+    Settings (app.config):
+        CACHE_METRICS_INTERVAL: seconds between lines; 0 turns them off
+    """
+
+    app.config.setdefault('CACHE_METRICS_INTERVAL', 300)
+
+    last_logged = monotonic()
+    last_logged_lock = Lock()
+
+    @app.after_request
+    def log_cache_metrics(response):
+        """Log cache metrics if the interval has passed since the last time.
+        """
+
+        nonlocal last_logged
+
+        interval = app.config['CACHE_METRICS_INTERVAL']
+        if not interval or monotonic() - last_logged < interval:
+            return response
+
+        with last_logged_lock:
+            if monotonic() - last_logged < interval:
+                return response
+            last_logged = monotonic()
+
+        logger.info(json.dumps({
+            "event": "cache_metrics",
+            "pid": os.getpid(),
+            "caches": cache_metrics(),
+        }))
+
+        return response
@@ -0,0 +1,260 @@
+"""Background account deletion for Warbler.
+
+Deleting an account only marks the user as deleted (`request_deletion`).
+A worker (`flask run-deletions`) then purges their data in small batches,
+one short transaction per batch, so no request waits on it and no batch
+holds row locks for long. Progress is recorded in account_deletions in the
+same transaction as each batch, so a worker that crashes part way picks up
+where it left off once its claim on the deletion expires.
+"""
+
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, tuple_, update
+
+from models import (
+    db, AccountDeletion, Follows, Like, Message, TimelineEntry, User
+)
+
+
+def purge_own_timeline(user_id, batch_size):
+    """Delete a batch of entries on the user's own home timeline."""
+
+    batch = (select(TimelineEntry.user_id, TimelineEntry.message_id)
+             .where(TimelineEntry.user_id == user_id)
+             .limit(batch_size))
+
+    return db.session.execute(
+        delete(TimelineEntry)
+        .where(tuple_(TimelineEntry.user_id, TimelineEntry.message_id)
+               .in_(batch))
+    ).rowcount
+
+
+def purge_fanned_out_entries(user_id, batch_size):
+    """Delete a batch of the user's messages from other users' timelines."""
+
+    batch = (select(TimelineEntry.user_id, TimelineEntry.message_id)
+             .where(TimelineEntry.author_id == user_id)
+             .limit(batch_size))
+
+    return db.session.execute(
+        delete(TimelineEntry)
+        .where(tuple_(TimelineEntry.user_id, TimelineEntry.message_id)
+               .in_(batch))
+    ).rowcount
+
+
+def purge_likes_given(user_id, batch_size):
+    """Delete a batch of the user's likes of other users' messages."""
+
+    batch = select(Like.id).where(Like.user_id == user_id).limit(batch_size)
+
+    return db.session.execute(
+        delete(Like).where(Like.id.in_(batch))
+    ).rowcount
+
+
+def purge_likes_received(user_id, batch_size):
+    """Delete a batch of likes of the user's messages, fixing likers' counts.
+
+    Counts are fixed from the likes actually deleted, so a like removed
+    concurrently (e.g. its liker unliked it) isn't uncounted twice.
+    """
+
+    batch = (select(Like.id)
+             .join(Message, Message.id == Like.message_id)
+             .where(Message.user_id == user_id)
+             .limit(batch_size))
+
+    liker_ids = db.session.scalars(
+        delete(Like)
+        .where(Like.id.in_(batch))
+        .returning(Like.user_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+    likers_by_count = {}
+    for liker_id, num_likes in Counter(liker_ids).items():
+        likers_by_count.setdefault(num_likes, []).append(liker_id)
+
+    for num_likes, ids in likers_by_count.items():
+        User.adjust_counts(ids, likes_count=-num_likes)
+
+    return len(liker_ids)
+
+
+def purge_following(user_id, batch_size):
+    """Delete a batch of the user's follows, fixing followed users' counts."""
+
+    batch = (select(Follows.user_following_id,
+                    Follows.user_being_followed_id)
+             .where(Follows.user_following_id == user_id)
+             .limit(batch_size))
+
+    followed_ids = db.session.scalars(
+        delete(Follows)
+        .where(tuple_(Follows.user_following_id,
+                      Follows.user_being_followed_id).in_(batch))
+        .returning(Follows.user_being_followed_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+    User.adjust_counts(followed_ids, followers_count=-1)
+
+    return len(followed_ids)
+
+
+def purge_followers(user_id, batch_size):
+    """Delete a batch of follows of the user, fixing followers' counts."""
+
+    batch = (select(Follows.user_following_id,
+                    Follows.user_being_followed_id)
+             .where(Follows.user_being_followed_id == user_id)
+             .limit(batch_size))
+
+    follower_ids = db.session.scalars(
+        delete(Follows)
+        .where(tuple_(Follows.user_following_id,
+                      Follows.user_being_followed_id).in_(batch))
+        .returning(Follows.user_following_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+    User.adjust_counts(follower_ids, following_count=-1)
+
+    return len(follower_ids)
+
+
+def purge_messages(user_id, batch_size):
+    """Delete a batch of the user's messages."""
+
+    batch = (select(Message.id)
+             .where(Message.user_id == user_id)
+             .limit(batch_size))
+
+    return db.session.execute(
+        delete(Message).where(Message.id.in_(batch))
+    ).rowcount
+
+
+def purge_user(user_id, batch_size):
+    """Delete the user row itself, once everything else is gone."""
+
+    return db.session.execute(
+        delete(User).where(User.id == user_id)
+    ).rowcount
+
+
+# Purge stages, in order; each runs in batches until it deletes nothing.
+# Timeline entries go first, so the user's messages leave timelines soonest.
+STAGES = [
+    ("own_timeline", purge_own_timeline),
+    ("fanned_out_entries", purge_fanned_out_entries),
+    ("likes_given", purge_likes_given),
+    ("likes_received", purge_likes_received),
+    ("following", purge_following),
+    ("followers", purge_followers),
+    ("messages", purge_messages),
+    ("user", purge_user),
+]
+
+DONE = "done"
+
+
+def request_deletion(user_id):
+    """Mark a user deleted and queue their data to be purged.
+
+    The caller commits. The user can't log in or be seen from then on, and
+    cached cards of their messages are invalidated.
+    """
+
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(deleted_at=datetime.utcnow(),
+                profile_version=User.profile_version + 1)
+    )
+
+    if not db.session.get(AccountDeletion, user_id):
+        db.session.add(
+            AccountDeletion(user_id=user_id, stage=STAGES[0][0]))
+
+
+def claim_next(lease_seconds):
+    """Claim the oldest unfinished, unclaimed deletion for this worker.
+
+    Claims expire after `lease_seconds` unless extended, so a deletion whose
+    worker died is picked up again. Returns the AccountDeletion, or None.
+    """
+
+    now = datetime.utcnow()
+
+    claimable = (select(AccountDeletion.user_id)
+                 .where(
+                     AccountDeletion.completed_at.is_(None),
+                     (AccountDeletion.claimed_until.is_(None)
+                      | (AccountDeletion.claimed_until < now)))
+                 .order_by(AccountDeletion.requested_at)
+                 .limit(1)
+                 .with_for_update(skip_locked=True))
+
+    user_id = db.session.scalar(
+        update(AccountDeletion)
+        .where(AccountDeletion.user_id == claimable.scalar_subquery())
+        .values(claimed_until=now + timedelta(seconds=lease_seconds))
+        .returning(AccountDeletion.user_id)
+    )
+    db.session.commit()
+
+    return user_id and db.session.get(AccountDeletion, user_id)
+
+
+def purge_account(deletion, batch_size=1000, lease_seconds=300, log=print):
+    """Purge the data of a claimed `deletion`, resuming at its stage."""
+
+    stage_names = [name for name, purge in STAGES]
+
+    while deletion.stage != DONE:
+        stage_index = stage_names.index(deletion.stage)
+        purge = STAGES[stage_index][1]
+
+        deleted = purge(deletion.user_id, batch_size)
+
+        deletion.rows_deleted += deleted
+        deletion.claimed_until = (
+            datetime.utcnow() + timedelta(seconds=lease_seconds))
+
+        if deleted < batch_size:
+            next_index = stage_index + 1
+            deletion.stage = (
+                stage_names[next_index] if next_index < len(STAGES) else DONE)
+
+        if deletion.stage == DONE:
+            deletion.completed_at = datetime.utcnow()
+
+        db.session.commit()
+
+        log(f"user {deletion.user_id}: {stage_names[stage_index]} "
+            f"-{deleted} rows ({deletion.rows_deleted} total)")
+
+
+def run_worker(batch_size=1000, lease_seconds=300, poll_seconds=5,
+               once=False, log=print):
+    """Purge queued deletions, one at a time, until stopped.
+
+    With `once`, returns when there's nothing left to claim instead of
+    polling for new deletions.
+    """
+
+    while True:
+        deletion = claim_next(lease_seconds)
+
+        if deletion:
+            purge_account(deletion, batch_size, lease_seconds, log)
+        elif once:
+            return
+        else:
+            time.sleep(poll_seconds)
@@ -0,0 +1,333 @@
+"""Generate large, reproducible CSV datasets for Warbler.
+
+Unlike create_csvs.py, this streams rows straight to disk (memory use
+doesn't grow with the dataset), needs no network access, and writes the
+same files for the same --seed, however many workers are used.
+
+Follows and likes are skewed the way real ones are: a few users have most
+of the followers and post most of the messages, a few messages get most of
+the likes, and how many users someone follows (or how many messages they
+like) is heavy-tailed too.
+
+Files are written in chunks (<table>-00000.csv, ...) by parallel worker
+processes, ready for seed.py to load in parallel:
+
+    python generator/generate_dataset.py --users 1000000 --messages 10000000
+    python seed.py --data-dir generator/dataset
+"""
+
+import argparse
+import csv
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from math import gcd
+from os import cpu_count
+from pathlib import Path
+from random import Random
+from time import perf_counter
+
+from faker import Faker
+from helpers import HEADER_IMAGE_URLS, PROFILE_IMAGE_URLS
+
+MAX_WARBLER_LENGTH = 140
+
+# Hash of "password", so every generated user can log in
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+USERS_CSV_HEADERS = [
+    'id', 'email', 'username', 'image_url', 'password', 'bio',
+    'header_image_url', 'location',
+]
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
+FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id', 'created_at']
+
+# Salts, so each derived value draws from its own stream
+AUTHORS, FOLLOWED, LIKED, TIMESTAMPS = 1, 2, 3, 4
+
+# Strides for scattering popularity ranks over ids (large primes)
+SCATTER_STRIDES = [2654435761, 2246822519, 3266489917]
+
+MASK_64 = (1 << 64) - 1
+
+
+def unit(*key):
+    """Return a float in [0, 1) determined only by the integers in `key`.
+
+    A splitmix64 hash: lets every worker derive the same value (e.g. the
+    author of a message) without sharing state or generating it in order.
+    """
+
+    x = 0
+    for part in key:
+        x = (x + part + 0x9E3779B97F4A7C15) & MASK_64
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK_64
+        x ^= x >> 31
+
+    return x / 2 ** 64
+
+
+class Popularity:
+    """Zipf-like choice of ids 1..n: the id ranked r is picked ~ 1 / r**s.
+
+    Ranks are drawn by inverting the distribution's continuous CDF, so this
+    takes constant memory for any n. Ranks are scattered over the ids, so
+    the most popular ids aren't simply the smallest ones.
+    """
+
+    def __init__(self, n, exponent, seed, salt):
+        self.n = n
+        self.exponent = exponent
+        self.stride = next(p for p in SCATTER_STRIDES if gcd(p, n) == 1)
+        self.offset = int(unit(seed, salt) * n)
+
+    def pick(self, u):
+        """Return the id for `u`, a uniform float in [0, 1)."""
+
+        n, s = self.n, self.exponent
+
+        if s == 1:
+            rank = (n + 1) ** u
+        else:
+            rank = (((n + 1) ** (1 - s) - 1) * u + 1) ** (1 / (1 - s))
+
+        rank = min(int(rank) - 1, n - 1)
+
+        return (rank * self.stride + self.offset) % n + 1
+
+
+def heavy_tailed_count(rng, mean, maximum, alpha=2.0):
+    """Return a Pareto-distributed count averaging about `mean`."""
+
+    scale = mean * (alpha - 1) / alpha
+
+    return min(int(scale * rng.paretovariate(alpha)), maximum)
+
+
+def chunk_rng(options, table, chunk):
+    """Return (Random, Faker) seeded for one chunk of one table."""
+
+    seed = f"{options.seed}:{table}:{chunk}"
+    fake = Faker()
+    fake.seed_instance(seed)
+
+    return Random(seed), fake
+
+
+def author_picker(options):
+    """Return a function giving the author's user id for a message id."""
+
+    authors = Popularity(
+        options.users, options.skew, options.seed, AUTHORS)
+
+    return lambda message_id: authors.pick(
+        unit(options.seed, AUTHORS, message_id))
+
+
+def timestamp_picker(options):
+    """Return a function giving the timestamp for a message id."""
+
+    end = datetime.fromisoformat(options.end)
+    span = timedelta(days=365 * options.years).total_seconds()
+
+    return lambda message_id: end - timedelta(
+        seconds=span * unit(options.seed, TIMESTAMPS, message_id))
+
+
+def write_users(options, chunk, first_id, last_id, writer):
+    rng, fake = chunk_rng(options, 'users', chunk)
+
+    for user_id in range(first_id, last_id + 1):
+        # Suffixing the id keeps usernames unique
+        username = f"{fake.user_name()}{user_id}"
+
+        writer.writerow([
+            user_id,
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(PROFILE_IMAGE_URLS),
+            PASSWORD,
+            fake.sentence(),
+            rng.choice(HEADER_IMAGE_URLS),
+            fake.city(),
+        ])
+
+    return last_id - first_id + 1
+
+
+def write_messages(options, chunk, first_id, last_id, writer):
+    rng, fake = chunk_rng(options, 'messages', chunk)
+    author_of = author_picker(options)
+    timestamp_of = timestamp_picker(options)
+
+    for message_id in range(first_id, last_id + 1):
+        writer.writerow([
+            message_id,
+            fake.paragraph()[:MAX_WARBLER_LENGTH],
+            timestamp_of(message_id),
+            author_of(message_id),
+        ])
+
+    return last_id - first_id + 1
+
+
+def write_follows(options, chunk, first_id, last_id, writer):
+    rng, _ = chunk_rng(options, 'follows', chunk)
+    followed = Popularity(
+        options.users, options.skew, options.seed, FOLLOWED)
+
+    rows = 0
+    for follower_id in range(first_id, last_id + 1):
+        count = heavy_tailed_count(
+            rng, options.follows_per_user, options.users - 1)
+
+        followed_ids = set()
+        for attempt in range(count * 4):
+            if len(followed_ids) == count:
+                break
+
+            followed_id = followed.pick(rng.random())
+            if followed_id != follower_id:
+                followed_ids.add(followed_id)
+
+        writer.writerows(
+            [followed_id, follower_id] for followed_id in followed_ids)
+        rows += len(followed_ids)
+
+    return rows
+
+
+def write_likes(options, chunk, first_id, last_id, writer):
+    rng, _ = chunk_rng(options, 'likes', chunk)
+    author_of = author_picker(options)
+    timestamp_of = timestamp_picker(options)
+    end = datetime.fromisoformat(options.end)
+    liked = Popularity(
+        options.messages, options.skew, options.seed, LIKED)
+
+    rows = 0
+    for user_id in range(first_id, last_id + 1):
+        count = heavy_tailed_count(
+            rng, options.likes_per_user, options.messages)
+
+        message_ids = set()
+        for attempt in range(count * 4):
+            if len(message_ids) == count:
+                break
+
+            # Users can't like their own messages
+            message_id = liked.pick(rng.random())
+            if author_of(message_id) != user_id:
+                message_ids.add(message_id)
+
+        # Liked some time between being posted and the end of the dataset
+        for message_id in message_ids:
+            posted_at = timestamp_of(message_id)
+            writer.writerow([
+                user_id,
+                message_id,
+                posted_at + (end - posted_at) * rng.random(),
+            ])
+        rows += len(message_ids)
+
+    return rows
+
+
+# Table: (headers, chunk writer, number of ids the chunks split up)
+TABLES = {
+    'users': (USERS_CSV_HEADERS, write_users, 'users'),
+    'messages': (MESSAGES_CSV_HEADERS, write_messages, 'messages'),
+    'follows': (FOLLOWS_CSV_HEADERS, write_follows, 'users'),
+    'likes': (LIKES_CSV_HEADERS, write_likes, 'users'),
+}
+
+
+def write_chunk(options, table, chunk, first_id, last_id):
+    """Write one chunk file of `table`; return rows written."""
+
+    headers, write_rows, id_count = TABLES[table]
+    path = Path(options.out, f"{table}-{chunk:05d}.csv")
+
+    with open(path, 'w', newline='') as chunk_csv:
+        writer = csv.writer(chunk_csv)
+        writer.writerow(headers)
+
+        return write_rows(options, chunk, first_id, last_id, writer)
+
+
+def chunks(options, table):
+    """Yield (chunk, first id, last id) for each chunk of `table`.
+
+    Follows and likes chunks cover users, sized so that files hold about
+    --chunk-size rows.
+    """
+
+    headers, write_rows, id_count = TABLES[table]
+    total = getattr(options, id_count)
+
+    rows_per_id = {
+        'follows': options.follows_per_user,
+        'likes': options.likes_per_user,
+    }.get(table, 1)
+    size = max(1, int(options.chunk_size / max(rows_per_id, 1)))
+
+    for chunk, first_id in enumerate(range(1, total + 1, size)):
+        yield chunk, first_id, min(first_id + size - 1, total)
+
+
+def generate(options):
+    Path(options.out).mkdir(parents=True, exist_ok=True)
+
+    for stale in Path(options.out).glob('*-*.csv'):
+        stale.unlink()
+
+    start = perf_counter()
+
+    with ProcessPoolExecutor(max_workers=options.workers) as executor:
+        jobs = [
+            (table, executor.submit(write_chunk, options, table, *chunk))
+            for table in TABLES
+            for chunk in chunks(options, table)
+        ]
+
+        rows = {}
+        for table, job in jobs:
+            rows[table] = rows.get(table, 0) + job.result()
+
+    seconds = perf_counter() - start
+
+    for table, count in rows.items():
+        print(f"{table:<10} {count:>12,} rows")
+    print(f"{'total':<10} {sum(rows.values()):>12,} rows "
+          f"{seconds:>8.2f}s  {sum(rows.values()) / seconds:,.0f} rows/s")
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--out", default="generator/dataset")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--follows-per-user", type=float, default=16)
+    parser.add_argument("--likes-per-user", type=float, default=8)
+    parser.add_argument(
+        "--skew", type=float, default=1.0,
+        help="Zipf exponent for popular authors, followed users and "
+             "liked messages")
+    parser.add_argument(
+        "--end", default="2023-01-01",
+        help="newest possible message timestamp")
+    parser.add_argument(
+        "--years", type=float, default=2,
+        help="how far back message timestamps go")
+    parser.add_argument(
+        "--chunk-size", type=int, default=100_000,
+        help="approximate rows per file")
+    parser.add_argument("--workers", type=int, default=cpu_count())
+
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    generate(parse_args())
@@ -12,3 +12,37 @@ def get_random_datetime(year_gap=2):
     random_timestamp = uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+# Profile and header images for generated users; these are plain URLs, so
+# generating data doesn't need any API access.
+
+PROFILE_IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+UNSPLASH_PHOTO_IDS = [
+    "1573996987033-47fd3a4ca35e", "1574001412492-7555e61a9b53",
+    "1575015642299-5b92fcbd0ba4", "1647598939382-5637f4eeb7b9",
+    "1653061853347-4fbf052530e9", "1668353064375-d3dcd3346d53",
+    "1669375957059-0cd563ba4a02", "1673844968943-694c71e94e93",
+    "1673950455470-d872dcec6eb1", "1674240568812-d7481f3699a7",
+    "1674318012388-141651b08a51", "1674394006641-b680753c502b",
+    "1674407728563-f30774195b0f", "1674420628423-bf7a338af32d",
+    "1674493310933-e681279e5664", "1674500021669-27da4b40772a",
+    "1674505681324-3ef7edf8415b", "1674530493752-719b5514a7f2",
+    "1674575496466-5119fd691bf4", "1674580351112-42fdbbae9c86",
+    "1674653743689-c8e507e3dee8", "1674653844677-b98dfbbc0ac5",
+    "1674673858080-fb524d0280a4", "1674690017732-63c3c5f8088c",
+    "1674754666443-696bc5b522f3", "1674754666581-4e6657392655",
+    "1674756142722-14266beb51d6", "1674824959440-09442ed75a8e",
+    "1674856320411-8c63716007d6",
+]
+
+HEADER_IMAGE_URLS = [
+    f"https://images.unsplash.com/photo-{photo_id}?crop=entropy"
+    "&cs=tinysrgb&fit=max&fm=jpg&ixlib=rb-4.0.3&q=80&w=1080"
+    for photo_id in UNSPLASH_PHOTO_IDS
+]
@@ -0,0 +1,129 @@
+"""Per-request SQL instrumentation for Warbler.
+
+Counts the statements each request issues and the time spent in the
+database, logs a structured line per request, logs slow statements, and
+keeps running totals per endpoint.
+"""
+
+import json
+import logging
+from collections import defaultdict
+from threading import Lock
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger("warbler.sql")
+
+_endpoint_totals = defaultdict(
+    lambda: {"requests": 0, "statements": 0, "db_ms": 0.0, "max_db_ms": 0.0})
+_endpoint_totals_lock = Lock()
+
+
+def redact_parameters(parameters):
+    """Return `parameters` with every value replaced by its type name."""
+
+    if isinstance(parameters, dict):
+        return {name: redact_parameters(value)
+                for name, value in parameters.items()}
+
+    if isinstance(parameters, (list, tuple)):
+        return [redact_parameters(value) for value in parameters]
+
+    return type(parameters).__name__
+
+
+def endpoint_stats():
+    """Return a copy of the per-endpoint SQL totals for this process."""
+
+    with _endpoint_totals_lock:
+        return {endpoint: dict(totals)
+                for endpoint, totals in _endpoint_totals.items()}
+
+
+def reset_endpoint_stats():
+    """Forget the per-endpoint SQL totals."""
+
+    with _endpoint_totals_lock:
+        _endpoint_totals.clear()
+
+
+def init_sql_instrumentation(app, engine):
+    """Hook SQL instrumentation into `app` and its database `engine`.
+
+    Settings (app.config):
+        SQL_INSTRUMENTATION: turn instrumentation on or off
+        SQL_SLOW_QUERY_MS: log statements slower than this
+        SQL_SLOWEST_PER_REQUEST: slowest statements kept in the request line
+    """
+
+    app.config.setdefault('SQL_INSTRUMENTATION', True)
+    app.config.setdefault('SQL_SLOW_QUERY_MS', 100)
+    app.config.setdefault('SQL_SLOWEST_PER_REQUEST', 3)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, many):
+        # Kept on the statement's execution context rather than the
+        # connection, so statements that fail leave nothing behind
+        context._query_start = perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def record_statement(conn, cursor, statement, parameters, context, many):
+        elapsed_ms = (perf_counter() - context._query_start) * 1000
+
+        if not (app.config['SQL_INSTRUMENTATION'] and has_request_context()):
+            return
+
+        stats = g.setdefault("sql_stats", {
+            "statements": 0, "db_ms": 0.0, "slowest": []})
+        stats["statements"] += 1
+        stats["db_ms"] += elapsed_ms
+
+        slowest = stats["slowest"]
+        slowest.append((elapsed_ms, statement))
+        slowest.sort(key=lambda item: item[0], reverse=True)
+        del slowest[app.config['SQL_SLOWEST_PER_REQUEST']:]
+
+        if elapsed_ms >= app.config['SQL_SLOW_QUERY_MS']:
+            logger.warning(json.dumps({
+                "event": "slow_query",
+                "endpoint": request.endpoint,
+                "ms": round(elapsed_ms, 2),
+                "statement": statement,
+                "parameters": redact_parameters(parameters),
+            }))
+
+    @app.after_request
+    def log_request_sql(response):
+        """Log SQL stats for this request and add them to endpoint totals."""
+
+        stats = g.pop("sql_stats", None)
+
+        if not stats:
+            return response
+
+        endpoint = request.endpoint or "<unmatched>"
+
+        with _endpoint_totals_lock:
+            totals = _endpoint_totals[endpoint]
+            totals["requests"] += 1
+            totals["statements"] += stats["statements"]
+            totals["db_ms"] += stats["db_ms"]
+            totals["max_db_ms"] = max(totals["max_db_ms"], stats["db_ms"])
+
+        logger.info(json.dumps({
+            "event": "request_sql",
+            "endpoint": endpoint,
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "statements": stats["statements"],
+            "db_ms": round(stats["db_ms"], 2),
+            "slowest": [
+                {"ms": round(ms, 2), "statement": statement}
+                for ms, statement in stats["slowest"]
+            ],
+        }))
+
+        return response
@@ -0,0 +1,334 @@
+"""Versioned schema migrations for Warbler.
+
+New databases get the full schema from `db.create_all()` (see seed.py);
+existing databases are brought up to date with `flask db-upgrade`, which
+applies each migration in MIGRATIONS that isn't yet recorded in the
+schema_migrations table.
+
+Migrations run in autocommit mode so indexes can be built with
+CREATE INDEX CONCURRENTLY on live tables, and every step is idempotent, so
+a migration that was interrupted part way can simply be run again.
+"""
+
+import json
+
+from sqlalchemy import text
+
+
+def sql(statement):
+    """Migration step running a single SQL `statement`."""
+
+    def step(conn):
+        conn.execute(text(statement))
+
+    step.description = " ".join(statement.split())
+    return step
+
+
+def create_index_concurrently(name, definition):
+    """Migration step building index `name` without locking out writes.
+
+    `definition` is everything after "CREATE INDEX CONCURRENTLY name", e.g.
+    "ON messages (user_id, timestamp, id)". A failed concurrent build leaves
+    an INVALID index behind; it's dropped and rebuilt rather than skipped.
+    """
+
+    unique = definition.startswith("UNIQUE ")
+    definition = definition.removeprefix("UNIQUE ")
+
+    def step(conn):
+        is_valid = conn.execute(text("""
+            SELECT indisvalid FROM pg_index
+            WHERE indexrelid = to_regclass(:name)
+        """), {"name": name}).scalar()
+
+        if is_valid:
+            return
+
+        if is_valid is False:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+        conn.execute(text(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY "
+            f"{name} {definition}"))
+
+    step.description = f"create index {name}"
+    return step
+
+
+def if_extension_available(extension, *steps):
+    """Migration step running `steps` only if `extension` can be installed."""
+
+    def step(conn):
+        available = conn.execute(text(
+            "SELECT EXISTS (SELECT FROM pg_available_extensions "
+            "WHERE name = :name)"), {"name": extension}).scalar()
+
+        if available:
+            conn.execute(text(f"CREATE EXTENSION IF NOT EXISTS {extension}"))
+            for inner_step in steps:
+                inner_step(conn)
+
+    step.description = f"if {extension} is available: " + "; ".join(
+        inner_step.description for inner_step in steps)
+    return step
+
+
+# (version, description, steps); append new migrations, never edit old ones
+MIGRATIONS = [
+    (1, "Timeline entries, user counters and username search", [
+        sql("""
+            CREATE TABLE IF NOT EXISTS timeline_entries (
+                user_id INTEGER NOT NULL
+                    REFERENCES users (id) ON DELETE CASCADE,
+                message_id INTEGER NOT NULL
+                    REFERENCES messages (id) ON DELETE CASCADE,
+                author_id INTEGER NOT NULL
+                    REFERENCES users (id) ON DELETE CASCADE,
+                timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                PRIMARY KEY (user_id, message_id)
+            )
+        """),
+        create_index_concurrently(
+            "ix_timeline_entries_user_timestamp",
+            "ON timeline_entries (user_id, timestamp, message_id)"),
+        create_index_concurrently(
+            "ix_timeline_entries_user_author",
+            "ON timeline_entries (user_id, author_id)"),
+        sql("""
+            ALTER TABLE users
+                ADD COLUMN IF NOT EXISTS messages_count
+                    INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS following_count
+                    INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS followers_count
+                    INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS likes_count
+                    INTEGER NOT NULL DEFAULT 0
+        """),
+        create_index_concurrently(
+            "ix_users_username_prefix",
+            "ON users (lower(username) text_pattern_ops)"),
+        if_extension_available("pg_trgm", create_index_concurrently(
+            "ix_users_username_trgm",
+            "ON users USING gin (lower(username) gin_trgm_ops)")),
+    ]),
+    (2, "Indexes and constraints for messages, follows and likes", [
+        create_index_concurrently(
+            "ix_messages_user_timestamp",
+            "ON messages (user_id, timestamp, id)"),
+        create_index_concurrently(
+            "ix_follows_user_following_id",
+            "ON follows (user_following_id, user_being_followed_id)"),
+        create_index_concurrently(
+            "ix_likes_message_id",
+            "ON likes (message_id)"),
+        # Keep the oldest of any duplicate likes before enforcing uniqueness
+        sql("""
+            DELETE FROM likes AS newer
+            USING likes AS older
+            WHERE newer.user_id = older.user_id
+              AND newer.message_id = older.message_id
+              AND newer.id > older.id
+        """),
+        create_index_concurrently(
+            "uq_likes_user_message",
+            "UNIQUE ON likes (user_id, message_id)"),
+        sql("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT FROM pg_constraint
+                    WHERE conname = 'uq_likes_user_message'
+                ) THEN
+                    ALTER TABLE likes
+                        ADD CONSTRAINT uq_likes_user_message
+                        UNIQUE USING INDEX uq_likes_user_message;
+                END IF;
+            END $$
+        """),
+    ]),
+    (3, "Background account deletion", [
+        sql("ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP"),
+        sql("""
+            CREATE TABLE IF NOT EXISTS account_deletions (
+                user_id INTEGER PRIMARY KEY,
+                stage TEXT NOT NULL,
+                rows_deleted INTEGER NOT NULL,
+                requested_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                claimed_until TIMESTAMP WITHOUT TIME ZONE,
+                completed_at TIMESTAMP WITHOUT TIME ZONE
+            )
+        """),
+        create_index_concurrently(
+            "ix_timeline_entries_author",
+            "ON timeline_entries (author_id)"),
+    ]),
+    (4, "Profile versions for cached message cards", [
+        sql("""
+            ALTER TABLE users
+                ADD COLUMN IF NOT EXISTS profile_version
+                    INTEGER NOT NULL DEFAULT 0
+        """),
+    ]),
+    # Existing likes get the migration time, as when they were made is
+    # unknown; now() is stable, so this doesn't rewrite the table
+    (5, "Like times for the liked messages page", [
+        sql("""
+            ALTER TABLE likes
+                ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL
+                    DEFAULT timezone('utc', now())
+        """),
+        create_index_concurrently(
+            "ix_likes_user_created",
+            "ON likes (user_id, created_at, id)"),
+    ]),
+    # Every author starts out fanned out; `flask rebalance-timelines`
+    # switches the popular ones to pulled
+    (6, "Pulled timeline messages for popular authors", [
+        sql("""
+            ALTER TABLE users
+                ADD COLUMN IF NOT EXISTS timeline_pull
+                    BOOLEAN NOT NULL DEFAULT false
+        """),
+    ]),
+]
+
+
+def applied_versions(conn):
+    """Return the set of migration versions applied to this database."""
+
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+        )
+    """))
+
+    return set(conn.execute(
+        text("SELECT version FROM schema_migrations")).scalars())
+
+
+def upgrade(engine, log=print):
+    """Apply every pending migration, in order.
+
+    Returns the list of versions that were applied.
+    """
+
+    applied = []
+
+    with engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT") as conn:
+        done = applied_versions(conn)
+
+        for version, description, steps in MIGRATIONS:
+            if version in done:
+                continue
+
+            log(f"Applying migration {version}: {description}")
+            for step in steps:
+                log(f"  {step.description}")
+                step(conn)
+
+            conn.execute(text(
+                "INSERT INTO schema_migrations (version, description) "
+                "VALUES (:version, :description)"),
+                {"version": version, "description": description})
+            applied.append(version)
+
+    return applied
+
+
+# (name, index the plan should use, SQL, parameters) for the hot queries
+EXPLAIN_CHECKS = [
+    ("home timeline", "ix_timeline_entries_user_timestamp", """
+        SELECT message_id FROM timeline_entries
+        WHERE user_id = :user_id
+        ORDER BY timestamp DESC, message_id DESC
+        LIMIT 100
+    """, {"user_id": 1}),
+    ("profile messages", "ix_messages_user_timestamp", """
+        SELECT id FROM messages
+        WHERE user_id = :user_id
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 100
+    """, {"user_id": 1}),
+    ("followed users", "ix_follows_user_following_id", """
+        SELECT user_being_followed_id FROM follows
+        WHERE user_following_id = :user_id
+        ORDER BY user_being_followed_id
+        LIMIT 49
+    """, {"user_id": 1}),
+    ("followers page", "follows_pkey", """
+        SELECT user_following_id FROM follows
+        WHERE user_being_followed_id = :user_id
+        ORDER BY user_following_id
+        LIMIT 49
+    """, {"user_id": 1}),
+    ("like lookup", "uq_likes_user_message", """
+        SELECT id FROM likes
+        WHERE user_id = :user_id AND message_id = :message_id
+    """, {"user_id": 1, "message_id": 1}),
+    ("liked messages page", "ix_likes_user_created", """
+        SELECT message_id FROM likes
+        WHERE user_id = :user_id
+        ORDER BY created_at DESC, id DESC
+        LIMIT 100
+    """, {"user_id": 1}),
+    ("likes of a message", "ix_likes_message_id", """
+        SELECT user_id FROM likes WHERE message_id = :message_id
+    """, {"message_id": 1}),
+    ("username prefix search", "ix_users_username_prefix", """
+        SELECT id FROM users WHERE lower(username) LIKE :prefix
+        ORDER BY lower(username) USING ~<~, id
+        LIMIT 49
+    """, {"prefix": "ab%"}),
+]
+
+
+def plan_indexes(plan):
+    """Return the names of every index used anywhere in an EXPLAIN plan."""
+
+    names = set()
+
+    if "Index Name" in plan:
+        names.add(plan["Index Name"])
+
+    for child in plan.get("Plans", []):
+        names |= plan_indexes(child)
+
+    return names
+
+
+def explain_checks(session):
+    """EXPLAIN each of EXPLAIN_CHECKS; return (name, index, used) tuples.
+
+    Sequential scans and explicit sorts are disabled for the check, so this
+    reports whether the planner *can* use each index (including for the
+    ORDER BY) even on tables too small for it to be worth it. Run it against
+    representative, ANALYZEd data: on nearly empty tables the planner's
+    choice between indexes is arbitrary. The surrounding transaction is
+    rolled back.
+    """
+
+    results = []
+
+    try:
+        session.execute(text("SET LOCAL enable_seqscan = off"))
+        session.execute(text("SET LOCAL enable_sort = off"))
+
+        for name, index, statement, params in EXPLAIN_CHECKS:
+            plan = session.execute(
+                text(f"EXPLAIN (FORMAT JSON) {statement}"), params).scalar()
+
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+
+            used = index in plan_indexes(plan[0]["Plan"])
+            results.append((name, index, used))
+
+    finally:
+        session.rollback()
+
+    return results
@@ -1,24 +1,54 @@
 """SQLAlchemy models for Warbler."""
 
 from datetime import datetime
+from inspect import getattr_static
+from itertools import groupby
+from operator import attrgetter
+from types import FunctionType, MethodType
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (
+    DDL, and_, case, delete, event, exists, func, literal, or_, select,
+    text, true, tuple_, union_all, update
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased, contains_eager, joinedload, validates
 from sqlalchemy.schema import CheckConstraint
-from sqlalchemy.orm import validates
 
-bcrypt = Bcrypt()
+from pagination import cut_page, merged_page
+from passwords import PooledBcrypt
+
+bcrypt = PooledBcrypt()
 db = SQLAlchemy()
 
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
 
+# Trigrams can't narrow down searches for terms shorter than this
+TRIGRAM_MIN_LENGTH = 3
+
+# Most substring (not prefix) matches a search page is chosen from
+SEARCH_SUBSTRING_CANDIDATES = 1000
+
+# Lowercase usernames in the bytewise order of ix_users_username_prefix
+# (text_pattern_ops), so it can serve ORDER BY as well as the range
+USERNAME_PATTERN_ORDER = text("lower(users.username) USING ~<~")
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
 
+    # The primary key serves lookups of a user's followers; this serves
+    # lookups of who a user follows
+    __table_args__ = (
+        db.Index(
+            'ix_follows_user_following_id',
+            'user_following_id', 'user_being_followed_id'
+        ),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -31,6 +61,68 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def follow(cls, user_id, followed_user_ids):
+        """Make `user_id` follow each user in `followed_user_ids`.
+
+        Ids that don't exist, are already followed, or are `user_id` itself
+        are skipped, as are deleted users; nothing is followed if `user_id`
+        is deleted. Updates counters and timelines for the new follows and
+        returns the list of newly followed user ids.
+        """
+
+        follower = aliased(User)
+        new_follows = (
+            insert(cls)
+            .from_select(
+                ['user_being_followed_id', 'user_following_id'],
+                select(User.id, literal(user_id)).where(
+                    User.id.in_(followed_user_ids),
+                    User.id != user_id,
+                    User.deleted_at.is_(None),
+                    select(follower.id).where(
+                        follower.id == user_id,
+                        follower.deleted_at.is_(None),
+                    ).exists(),
+                ))
+            .on_conflict_do_nothing()
+            .returning(cls.user_being_followed_id)
+        )
+
+        followed_ids = list(db.session.scalars(new_follows))
+
+        if followed_ids:
+            User.adjust_counts([user_id], following_count=len(followed_ids))
+            User.adjust_counts(followed_ids, followers_count=1)
+            TimelineEntry.backfill(user_id, followed_ids)
+
+        return followed_ids
+
+    @classmethod
+    def unfollow(cls, user_id, followed_user_id):
+        """Make `user_id` stop following `followed_user_id`.
+
+        Updates counters and timelines; returns whether a follow existed.
+        """
+
+        removed = db.session.scalar(
+            delete(cls)
+            .where(
+                cls.user_following_id == user_id,
+                cls.user_being_followed_id == followed_user_id,
+            )
+            .returning(cls.user_being_followed_id)
+        )
+
+        if removed is None:
+            return False
+
+        User.adjust_counts([user_id], following_count=-1)
+        User.adjust_counts([followed_user_id], followers_count=-1)
+        TimelineEntry.prune(user_id, followed_user_id)
+
+        return True
+
 
 class User(db.Model):
     """User in the system."""
@@ -82,8 +174,76 @@ class User(db.Model):
         nullable=False
     )
 
+    # Denormalized counts, kept in step with the base tables by the views
+    # (see `adjust_counts`) and repaired by `reconcile_counts`
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+    # Set when the user deletes their account; their data is then purged
+    # in the background (see deletion.py)
+    deleted_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    # Bumped whenever what's shown of the user on message cards may change,
+    # which invalidates their cached cards (see message_card in app.py)
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set for authors with so many followers that their messages aren't
+    # copied into followers' timelines, but read from messages when a
+    # timeline is shown (see TimelineEntry)
+    timeline_pull = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default='false',
+    )
+
     authored_messages = db.relationship('Message', backref="author")
 
+    # Denormalized counts (see adjust_counts)
+    COUNTER_COLUMNS = (
+        'messages_count', 'following_count', 'followers_count', 'likes_count',
+    )
+
+    # Columns shown on user cards, e.g. on followers/following pages
+    CARD_COLUMNS = (
+        'id', 'username', 'image_url', 'header_image_url', 'bio',
+        'profile_version',
+    )
+
     followers = db.relationship(
         "User",
         secondary="follows",
@@ -97,6 +257,12 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @classmethod
+    def active(cls):
+        """Query for users who haven't deleted their account."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
     @classmethod
     def signup(cls, username, email, password, image_url=DEFAULT_IMAGE_URL):
         """Sign up user.
@@ -126,30 +292,380 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        If the user's hash was made with a different work factor than the
+        one configured, it's replaced with a new hash of `password`; the
+        caller commits.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
+                if bcrypt.needs_rehash(user.password):
+                    user.password = (bcrypt
+                                     .generate_password_hash(password)
+                                     .decode('UTF-8'))
+
                 return user
 
         return False
 
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to the counters of users in `user_ids`.
+
+        `user_ids` may be a list of ids or a select of ids, e.g.:
+
+            User.adjust_counts([user.id], followers_count=1)
+        """
+
+        db.session.execute(
+            update(cls)
+            .where(cls.id.in_(user_ids))
+            .values({
+                getattr(cls, name): getattr(cls, name) + delta
+                for name, delta in deltas.items()
+            })
+        )
+
+    @classmethod
+    def bump_profile_version(cls, user_id):
+        """Mark the profile of `user_id` as changed.
+
+        Cached renderings that show the profile are keyed by its version, so
+        this invalidates them.
+        """
+
+        db.session.execute(
+            update(cls)
+            .where(cls.id == user_id)
+            .values(profile_version=cls.profile_version + 1)
+        )
+
+    @classmethod
+    def counts_of(cls, user_id):
+        """Return the COUNTER_COLUMNS of `user_id` as a dict, or None."""
+
+        row = db.session.execute(
+            select(*(getattr(cls, name) for name in cls.COUNTER_COLUMNS))
+            .where(cls.id == user_id)
+        ).one_or_none()
+
+        return row and dict(row._mapping)
+
+    @classmethod
+    def uncount_likes_of(cls, message_criteria):
+        """Decrement likes_count for likes of messages that are going away.
+
+        `message_criteria` is a filter on Message selecting those messages.
+        Call this before deleting them, while their likes still exist.
+        Returns the ids of the users whose likes_count changed.
+        """
+
+        likes = (select(Like.user_id, func.count().label('num_likes'))
+                 .join(Message, Message.id == Like.message_id)
+                 .where(message_criteria)
+                 .group_by(Like.user_id)
+                 .subquery())
+
+        return list(db.session.scalars(
+            update(cls)
+            .where(cls.id == likes.c.user_id)
+            .values(likes_count=cls.likes_count - likes.c.num_likes)
+            .returning(cls.id)
+        ))
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counters from the base tables."""
+
+        def count_of(model, *criteria):
+            return (select(func.count())
+                    .select_from(model)
+                    .where(*criteria)
+                    .scalar_subquery())
+
+        db.session.execute(
+            update(cls).values(
+                messages_count=count_of(Message, Message.user_id == cls.id),
+                following_count=count_of(
+                    Follows, Follows.user_following_id == cls.id),
+                followers_count=count_of(
+                    Follows, Follows.user_being_followed_id == cls.id),
+                likes_count=count_of(Like, Like.user_id == cls.id),
+            ),
+            execution_options={"synchronize_session": False},
+        )
+
+    @classmethod
+    def search_page(cls, term, per_page, after=None):
+        """Fetch one page of users whose username contains `term`, best first.
+
+        Rows are (user, rank, sort_name), ordered by rank (exact match, then
+        prefix match, then any other match), then lowercase username (as
+        bytes), then id. `after` is an optional (rank, sort_name, id) from
+        the previous page. Returns (rows, next_cursor), as keyset_page does.
+
+        Exact and prefix matches are an ordered range scan of the
+        lower(username) pattern index; an exact match sorts before the
+        longer names it prefixes, so that's already rank order. Only if
+        they don't fill the page are other matches found with the trigram
+        index, taking the page from at most SEARCH_SUBSTRING_CANDIDATES of
+        them, so common terms cost no more than rare ones. Terms shorter
+        than TRIGRAM_MIN_LENGTH only match username prefixes.
+        """
+
+        term = term.lower()
+        sort_name = func.lower(cls.username)
+        is_prefix = sort_name.startswith(term, autoescape=True)
+        after_rank = after[0] if after else -1
+
+        def after_name(query):
+            # (sort_name, id) > after's, with the first comparison usable as
+            # the start of an index range
+            _, name, user_id = after
+            return query.filter(
+                sort_name.bool_op('~>=~')(name),
+                or_(sort_name.bool_op('~>~')(name), cls.id > user_id))
+
+        rows = []
+
+        if after_rank < 2:
+            prefixed = (db.session
+                        .query(cls,
+                               case((sort_name == term, 0), else_=1)
+                               .label('rank'),
+                               sort_name.label('sort_name'))
+                        .filter(is_prefix, cls.deleted_at.is_(None))
+                        .order_by(USERNAME_PATTERN_ORDER, cls.id))
+            if after:
+                prefixed = after_name(prefixed)
+
+            rows = prefixed.limit(per_page + 1).all()
+
+        if len(rows) <= per_page and len(term) >= TRIGRAM_MIN_LENGTH:
+            candidates = (db.session.query(cls.id)
+                          .filter(sort_name.contains(term, autoescape=True),
+                                  ~is_prefix,
+                                  cls.deleted_at.is_(None)))
+            if after_rank == 2:
+                candidates = after_name(candidates)
+
+            rows += (db.session
+                     .query(cls, literal(2).label('rank'),
+                            sort_name.label('sort_name'))
+                     .filter(cls.id.in_(
+                         candidates.limit(SEARCH_SUBSTRING_CANDIDATES)))
+                     .order_by(USERNAME_PATTERN_ORDER, cls.id)
+                     .limit(per_page + 1 - len(rows))
+                     .all())
+
+        return cut_page(
+            rows,
+            per_page,
+            key=lambda row: (row.rank, row.sort_name, row.User.id),
+        )
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.scalar(select(exists().where(
+            Follows.user_being_followed_id == self.id,
+            Follows.user_following_id == other_user.id,
+        )))
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        return db.session.scalar(select(exists().where(
+            Follows.user_being_followed_id == other_user.id,
+            Follows.user_following_id == self.id,
+        )))
+
+    @classmethod
+    def cards(cls):
+        """Query for just the columns shown on user cards, of active users.
+
+        Rows have the CARD_COLUMNS as attributes, like a User would.
+        """
+
+        return (db.session
+                .query(*(getattr(cls, name) for name in cls.CARD_COLUMNS))
+                .filter(cls.deleted_at.is_(None)))
+
+    @classmethod
+    def following_of(cls, user_id, after=None):
+        """Query for cards of the users `user_id` follows, by id.
+
+        `after` is an optional user id; only users after it are returned.
+        Served in order by the (user_following_id, user_being_followed_id)
+        index, so a page costs the same however many users are followed.
+        """
+
+        query = (cls.cards()
+                 .join(Follows, Follows.user_being_followed_id == cls.id)
+                 .filter(Follows.user_following_id == user_id)
+                 .order_by(Follows.user_being_followed_id))
+
+        if after:
+            query = query.filter(Follows.user_being_followed_id > after)
+
+        return query
+
+    @classmethod
+    def followers_of(cls, user_id, after=None):
+        """Query for cards of the users following `user_id`, by id.
+
+        `after` is an optional user id; only users after it are returned.
+        Served in order by the follows primary key.
+        """
+
+        query = (cls.cards()
+                 .join(Follows, Follows.user_following_id == cls.id)
+                 .filter(Follows.user_being_followed_id == user_id)
+                 .order_by(Follows.user_following_id))
+
+        if after:
+            query = query.filter(Follows.user_following_id > after)
+
+        return query
+
+    def following_status(self, user_ids):
+        """Return the set of `user_ids` that this user is following.
+
+        Lets a page of user cards look up follow state in one query.
+        """
+
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            select(Follows.user_being_followed_id).where(
+                Follows.user_following_id == self.id,
+                Follows.user_being_followed_id.in_(user_ids),
+            )
+        ))
+
+
+class AccountGone(Exception):
+    """The logged in user's account no longer exists.
+
+    Raised by CurrentUser when it needs the User row, but the account was
+    purged after the user's profile was cached.
+    """
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+    def __init__(self, user_id):
+        super().__init__(f"User #{user_id} no longer exists")
+        self.user_id = user_id
+
+
+class CurrentUser:
+    """Lazy stand-in for the logged in User, used as `g.user`.
+
+    Columns in `profile` (a dict, usually from the profile cache) are served
+    without a query, and so are the counters, from `counts` (a function
+    returning User.counts_of, usually from the counter cache) called the
+    first time one is used. User methods are bound to the stand-in, so
+    methods that only need `id` don't load the row either. Anything else
+    loads the User on first use and is delegated to it.
+    """
+
+    PROFILE_COLUMNS = (
+        'id', 'username', 'email', 'image_url', 'header_image_url', 'bio',
+        'location', 'profile_version',
+    )
+
+    def __init__(self, user_id, profile=None, user=None, counts=None):
+        object.__setattr__(self, '_user_id', user_id)
+        object.__setattr__(self, '_profile', profile or {})
+        object.__setattr__(self, '_user', user)
+        object.__setattr__(self, '_counts', counts)
+
+    @classmethod
+    def profile_of(cls, user):
+        """Return the cacheable profile columns of `user` as a dict."""
+
+        return {name: getattr(user, name) for name in cls.PROFILE_COLUMNS}
+
+    def load(self):
+        """Return the User instance, loading it if needed.
+
+        Raises AccountGone if there's no such user any more.
+        """
+
+        if self._user is None:
+            user = db.session.get(User, self._user_id)
+            if user is None:
+                raise AccountGone(self._user_id)
+            object.__setattr__(self, '_user', user)
+
+        return self._user
+
+    def is_active(self):
+        """Does the account still exist, and not deleted?
+
+        The cached profile may predate the account's deletion, so unless the
+        User is loaded already this asks the database.
+        """
+
+        if self._user is not None:
+            return self._user.deleted_at is None
+
+        return db.session.query(
+            User.active().filter_by(id=self._user_id).exists()).scalar()
+
+    def __getattr__(self, name):
+        if self._user is None and name in self._profile:
+            return self._profile[name]
+
+        if (self._user is None and self._counts
+                and name in User.COUNTER_COLUMNS):
+            # Copied, as the profile dict may be shared with its cache
+            counts = self._counts() or {}
+            object.__setattr__(self, '_profile', {**self._profile, **counts})
+            object.__setattr__(self, '_counts', None)
+
+            if name in counts:
+                return counts[name]
+
+        method = getattr_static(User, name, None)
+        if isinstance(method, FunctionType):
+            return MethodType(method, self)
+
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
+    def __eq__(self, other):
+        return self._user_id == getattr(other, 'id', None)
+
+    def __hash__(self):
+        return hash(self._user_id)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self._user_id}>"
+
+
+# Username search indexes: a pattern index for prefix matches and, where the
+# pg_trgm extension is installed, a trigram index for substring matches.
+event.listen(User.__table__, 'after_create', DDL("""
+    CREATE INDEX ix_users_username_prefix
+        ON users (lower(username) text_pattern_ops);
+
+    DO $$
+    BEGIN
+        IF EXISTS (
+            SELECT FROM pg_available_extensions WHERE name = 'pg_trgm'
+        ) THEN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX ix_users_username_trgm
+                ON users USING gin (lower(username) gin_trgm_ops);
+        END IF;
+    END $$;
+"""))
 
 
 class Message(db.Model):
@@ -159,6 +675,7 @@ class Message(db.Model):
 
     __table_args__ = (
         CheckConstraint('char_length(text) > 0', name='text_min_length'),
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
     )
 
     @validates('text')
@@ -197,12 +714,83 @@ class Message(db.Model):
         secondary='likes',
         backref='liked_messages')
 
+    @classmethod
+    def with_author(cls):
+        """Query for messages that loads each author in the same SELECT."""
+
+        return cls.query.options(joinedload(cls.author))
+
+    @classmethod
+    def with_active_author(cls):
+        """Query for messages whose authors haven't deleted their account,
+        loading each author in the same SELECT.
+
+        Messages of deleted users are hidden from then on, though they're
+        only purged later (see deletion.py).
+        """
+
+        return (cls.query
+                .join(cls.author)
+                .filter(User.deleted_at.is_(None))
+                .options(contains_eager(cls.author)))
+
+    @classmethod
+    def authored_by(cls, user_id, before=None):
+        """Query for messages written by `user_id`, newest first.
+
+        `before` is an optional (timestamp, message_id) pair; only messages
+        strictly older than it are returned. The (user_id, timestamp, id)
+        index serves this without sorting.
+        """
+
+        query = (cls
+                 .with_author()
+                 .filter(cls.user_id == user_id)
+                 .order_by(cls.timestamp.desc(), cls.id.desc()))
+
+        if before:
+            query = query.filter(
+                tuple_(cls.timestamp, cls.id) < tuple_(*before))
+
+        return query
+
+    @classmethod
+    def liked_by(cls, user_id, before=None):
+        """Query for messages liked by `user_id`, most recently liked first.
+
+        Rows are (Message, liked_at, like_id). `before` is an optional
+        (liked_at, like_id) pair; only messages liked strictly before it are
+        returned. The (user_id, created_at, id) likes index serves this
+        without sorting, and authors are loaded in the same SELECT.
+        """
+
+        query = (cls
+                 .with_active_author()
+                 .join(Like, Like.message_id == cls.id)
+                 .add_columns(Like.created_at.label('liked_at'),
+                              Like.id.label('like_id'))
+                 .filter(Like.user_id == user_id)
+                 .order_by(Like.created_at.desc(), Like.id.desc()))
+
+        if before:
+            query = query.filter(
+                tuple_(Like.created_at, Like.id) < tuple_(*before))
+
+        return query
+
 
 class Like(db.Model):
     """Messages liked by Users"""
 
     __tablename__ = "likes"
 
+    __table_args__ = (
+        db.UniqueConstraint(
+            'user_id', 'message_id', name='uq_likes_user_message'),
+        db.Index('ix_likes_message_id', 'message_id'),
+        db.Index('ix_likes_user_created', 'user_id', 'created_at', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -221,6 +809,495 @@ class Like(db.Model):
         nullable=False
     )
 
+    # When the message was liked; the server default covers TOGGLE_SQL
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=text("timezone('utc', now())")
+    )
+
+    # Deletes the like if it exists, else adds it (unless the message is
+    # the user's own), and adjusts the user's likes_count to match. Deleted
+    # users' messages, and deleted users, are left alone: their likes are
+    # being purged, and purging them adjusts the counts.
+    TOGGLE_SQL = text("""
+        WITH target AS (
+            SELECT messages.id, messages.user_id
+            FROM messages
+            JOIN users AS author
+                ON author.id = messages.user_id
+                AND author.deleted_at IS NULL
+            WHERE messages.id = :message_id
+              AND EXISTS (
+                  SELECT FROM users
+                  WHERE id = :user_id AND deleted_at IS NULL)
+        ), removed AS (
+            DELETE FROM likes
+            WHERE user_id = :user_id
+              AND message_id IN (
+                  SELECT id FROM target WHERE user_id != :user_id)
+            RETURNING id
+        ), added AS (
+            INSERT INTO likes (user_id, message_id)
+            SELECT :user_id, id FROM target
+            WHERE user_id != :user_id AND NOT EXISTS (SELECT FROM removed)
+            ON CONFLICT (user_id, message_id) DO NOTHING
+            RETURNING id
+        ), counted AS (
+            UPDATE users
+            SET likes_count = likes_count
+                + (SELECT count(*) FROM added)
+                - (SELECT count(*) FROM removed)
+            WHERE id = :user_id
+        )
+        SELECT
+            (SELECT user_id FROM target) AS author_id,
+            NOT EXISTS (SELECT FROM removed) AS liked,
+            (SELECT count(*) FROM likes WHERE message_id = :message_id)
+                + (SELECT count(*) FROM added)
+                - (SELECT count(*) FROM removed) AS like_count
+    """)
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like or unlike a message for a user, in a single statement.
+
+        Returns a row of (author_id, liked, like_count). author_id is None if
+        the message doesn't exist, or its author or `user_id` is deleted; if
+        it's `user_id`, nothing was changed, since users can't like their own
+        messages.
+        """
+
+        return db.session.execute(
+            cls.TOGGLE_SQL,
+            {"user_id": user_id, "message_id": message_id}
+        ).one()
+
+    @classmethod
+    def liked_message_ids(cls, user_id, message_ids):
+        """Return the set of `message_ids` that `user_id` has liked."""
+
+        if not message_ids:
+            return set()
+
+        return set(db.session.scalars(
+            select(cls.message_id).where(
+                cls.user_id == user_id,
+                cls.message_id.in_(message_ids),
+            )
+        ))
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Entries are written when a message is posted (fan-out on write) and when
+    a user follows someone, so the homepage can read most of a user's
+    timeline as a single range scan over (user_id, timestamp).
+
+    Copying a message to every follower gets too costly for authors with
+    very many followers, so once an author reaches the pull threshold
+    (User.timeline_pull), their messages are only added to their own
+    timeline. `page_for` pulls the latest messages of such authors a user
+    follows when the timeline is read and merges them with its entries.
+    """
+
+    __tablename__ = "timeline_entries"
+
+    __table_args__ = (
+        db.Index(
+            'ix_timeline_entries_user_timestamp',
+            'user_id', 'timestamp', 'message_id'
+        ),
+        db.Index('ix_timeline_entries_user_author', 'user_id', 'author_id'),
+        db.Index('ix_timeline_entries_author', 'author_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    COLUMNS = ('user_id', 'message_id', 'author_id', 'timestamp')
+
+    @classmethod
+    def fan_out(cls, message, pull_threshold=None):
+        """Add `message` to the timelines of its author and their followers.
+
+        The message must already be flushed so that it has an id. Authors
+        with `pull_threshold` or more followers are switched to having their
+        messages pulled, and then only get the entry on their own timeline.
+        Returns the ids of the users whose timelines it was added to.
+        """
+
+        pulled = User.timeline_pull
+        if pull_threshold:
+            pulled = or_(pulled, User.followers_count >= pull_threshold)
+
+        # Locks the author's row, so this can't race with push_author
+        is_pulled = db.session.scalar(
+            update(User)
+            .where(User.id == message.user_id, pulled)
+            .values(timeline_pull=True)
+            .returning(User.id)
+            .execution_options(synchronize_session=False)
+        )
+
+        followers = select(
+            Follows.user_following_id,
+            literal(message.id),
+            literal(message.user_id),
+            literal(message.timestamp),
+        ).where(Follows.user_being_followed_id == message.user_id)
+
+        author = select(
+            literal(message.user_id),
+            literal(message.id),
+            literal(message.user_id),
+            literal(message.timestamp),
+        )
+
+        return list(db.session.scalars(
+            insert(cls)
+            .from_select(
+                cls.COLUMNS,
+                author if is_pulled else union_all(author, followers))
+            .on_conflict_do_nothing()
+            .returning(cls.user_id)
+        ))
+
+    @classmethod
+    def backfill(cls, user_id, followed_user_ids):
+        """Copy messages by `followed_user_ids` into `user_id`'s timeline.
+
+        Messages of authors whose messages are pulled are left out.
+        """
+
+        messages = (
+            select(literal(user_id), Message.id, Message.user_id,
+                   Message.timestamp)
+            .join(User, User.id == Message.user_id)
+            .where(Message.user_id.in_(followed_user_ids),
+                   User.timeline_pull.is_(False))
+        )
+
+        db.session.execute(
+            insert(cls)
+            .from_select(cls.COLUMNS, messages)
+            .on_conflict_do_nothing()
+        )
+
+    @classmethod
+    def prune(cls, user_id, followed_user_id):
+        """Remove messages by `followed_user_id` from `user_id`'s timeline."""
+
+        db.session.execute(
+            delete(cls).where(
+                cls.user_id == user_id,
+                cls.author_id == followed_user_id,
+            )
+        )
+
+    @classmethod
+    def rebuild(cls, user_id):
+        """Rebuild `user_id`'s timeline from follows and messages.
+
+        Missing entries are inserted and stale ones removed, including those
+        of authors whose messages are now pulled; entries that are already
+        correct are left alone, so this is safe to run while the app is
+        serving traffic.
+        """
+
+        followed_ids = (select(Follows.user_being_followed_id)
+                        .join(User, User.id == Follows.user_being_followed_id)
+                        .where(Follows.user_following_id == user_id,
+                               User.timeline_pull.is_(False)))
+
+        messages = select(
+            literal(user_id),
+            Message.id,
+            Message.user_id,
+            Message.timestamp,
+        ).where(or_(
+            Message.user_id == user_id,
+            Message.user_id.in_(followed_ids),
+        ))
+
+        db.session.execute(
+            delete(cls).where(
+                cls.user_id == user_id,
+                cls.author_id != user_id,
+                cls.author_id.not_in(followed_ids),
+            )
+        )
+
+        db.session.execute(
+            insert(cls)
+            .from_select(cls.COLUMNS, messages)
+            .on_conflict_do_nothing()
+        )
+
+    @classmethod
+    def rebuild_all(cls, pull_threshold=None):
+        """Build every user's timeline at once, e.g. after a bulk load.
+
+        Unlike `rebuild`, this doesn't remove stale entries; it's meant for
+        filling an empty table. Authors with `pull_threshold` or more
+        followers are switched to having their messages pulled first, and
+        aren't copied. Returns the number of entries added.
+        """
+
+        if pull_threshold:
+            cls.pull_popular_authors(pull_threshold)
+
+        followed = (
+            select(Follows.user_following_id, Message.id, Message.user_id,
+                   Message.timestamp)
+            .join(Message, Message.user_id == Follows.user_being_followed_id)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .where(User.timeline_pull.is_(False))
+        )
+
+        own = select(
+            Message.user_id,
+            Message.id,
+            Message.user_id,
+            Message.timestamp,
+        )
+
+        return db.session.execute(
+            insert(cls)
+            .from_select(cls.COLUMNS, union_all(own, followed))
+            .on_conflict_do_nothing()
+        ).rowcount
+
+    @classmethod
+    def messages_for(cls, user_id, before=None):
+        """Query for messages on `user_id`'s timeline, newest first.
+
+        `before` is an optional (timestamp, message_id) pair; only messages
+        strictly older than it are returned.
+        """
+
+        query = (Message
+                 .with_active_author()
+                 .join(cls, and_(
+                     cls.message_id == Message.id,
+                     cls.user_id == user_id,
+                 ))
+                 .order_by(cls.timestamp.desc(), cls.message_id.desc()))
+
+        if before:
+            query = query.filter(
+                tuple_(cls.timestamp, cls.message_id) < tuple_(*before))
+
+        return query
+
+    @classmethod
+    def pulled_keys_for(cls, user_id, per_author, before=None):
+        """Select the latest messages of pulled authors `user_id` follows.
+
+        Rows are (user_id, timestamp, id) of up to `per_author` messages of
+        each author, grouped by author and newest first within each, each
+        author's served by the (user_id, timestamp, id) index. `before` is
+        as for `messages_for`.
+        """
+
+        authors = (select(Follows.user_being_followed_id.label('author_id'))
+                   .join(User, User.id == Follows.user_being_followed_id)
+                   .where(Follows.user_following_id == user_id,
+                          User.timeline_pull,
+                          User.deleted_at.is_(None))
+                   .subquery())
+
+        latest = (select(Message.user_id, Message.timestamp, Message.id)
+                  .where(Message.user_id == authors.c.author_id))
+
+        if before:
+            latest = latest.where(
+                tuple_(Message.timestamp, Message.id) < tuple_(*before))
+
+        latest = (latest
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(per_author)
+                  .lateral())
+
+        return (select(latest)
+                .select_from(authors)
+                .join(latest, true())
+                .order_by(latest.c.user_id,
+                          latest.c.timestamp.desc(),
+                          latest.c.id.desc()))
+
+    @classmethod
+    def follows_pulled_authors(cls, user_id):
+        """Does `user_id` follow any author whose messages are pulled?"""
+
+        return db.session.scalar(select(
+            select(Follows.user_being_followed_id)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id,
+                   User.timeline_pull,
+                   User.deleted_at.is_(None))
+            .exists()
+        ))
+
+    @classmethod
+    def page_for(cls, user_id, per_page, before=None):
+        """Fetch one page of messages on `user_id`'s timeline, newest first.
+
+        Heap-merges the timeline's entries with the latest messages of each
+        pulled author `user_id` follows, by (timestamp, id). Only the keys
+        of pulled messages are fetched for the merge; those that make the
+        page are then loaded, so this takes at most three queries however
+        many authors are pulled. `before` is as for `messages_for`. Returns
+        (messages, next_cursor), as keyset_page does.
+        """
+
+        pushed = cls.messages_for(user_id, before=before).limit(per_page + 1)
+        pulled = db.session.execute(
+            cls.pulled_keys_for(user_id, per_page + 1, before=before))
+
+        runs = [pushed.all()] + [
+            list(keys)
+            for author_id, keys in groupby(pulled, key=attrgetter('user_id'))
+        ]
+
+        rows, next_cursor = merged_page(
+            runs,
+            per_page,
+            key=lambda row: (row.timestamp, row.id),
+        )
+
+        pulled_ids = [row.id for row in rows if not isinstance(row, Message)]
+
+        if pulled_ids:
+            loaded = {
+                message.id: message
+                for message in Message.with_active_author()
+                .filter(Message.id.in_(pulled_ids))
+            }
+            # Skipping any deleted since the merge
+            rows = [
+                row if isinstance(row, Message) else loaded[row.id]
+                for row in rows
+                if isinstance(row, Message) or row.id in loaded
+            ]
+
+        return rows, next_cursor
+
+    @classmethod
+    def pull_popular_authors(cls, pull_threshold):
+        """Switch authors with `pull_threshold` or more followers to pulled.
+
+        Followers are counted from follows, so this doesn't rely on the
+        counters (e.g. right after a bulk load). Entries already copied
+        stay until timelines are rebuilt. Returns the number switched.
+        """
+
+        popular = (select(Follows.user_being_followed_id)
+                   .group_by(Follows.user_being_followed_id)
+                   .having(func.count() >= pull_threshold))
+
+        return db.session.execute(
+            update(User)
+            .where(User.id.in_(popular), User.timeline_pull.is_(False))
+            .values(timeline_pull=True),
+            execution_options={"synchronize_session": False},
+        ).rowcount
+
+    @classmethod
+    def push_author(cls, author_id):
+        """Switch a pulled author back to having their messages fanned out.
+
+        Copies their messages into their followers' timelines. The author's
+        row is updated first, which locks it until commit, so messages they
+        post meanwhile are fanned out too (see fan_out). Returns the number
+        of entries added.
+        """
+
+        db.session.execute(
+            update(User)
+            .where(User.id == author_id)
+            .values(timeline_pull=False),
+            execution_options={"synchronize_session": False},
+        )
+
+        messages = (
+            select(Follows.user_following_id, Message.id, Message.user_id,
+                   Message.timestamp)
+            .join(Message, Message.user_id == Follows.user_being_followed_id)
+            .where(Follows.user_being_followed_id == author_id)
+        )
+
+        return db.session.execute(
+            insert(cls)
+            .from_select(cls.COLUMNS, messages)
+            .on_conflict_do_nothing()
+        ).rowcount
+
+
+class AccountDeletion(db.Model):
+    """Progress of purging a deleted account's data (see deletion.py)."""
+
+    __tablename__ = "account_deletions"
+
+    # Not a foreign key: this row outlives the user row it tracks
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    # Name of the purge stage in progress, or "done"
+    stage = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # A worker holds this deletion until then; extended after each batch
+    claimed_until = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+    completed_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -230,3 +1307,4 @@ def connect_db(app):
     app.app_context().push()
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
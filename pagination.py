@@ -0,0 +1,94 @@
+"""Keyset (cursor) pagination helpers for Warbler."""
+
+import heapq
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+
+from werkzeug.exceptions import BadRequest
+
+
+def encode_cursor(*values):
+    """Encode the sort key of the last row on a page as an opaque string."""
+
+    raw = json.dumps([
+        value.isoformat() if isinstance(value, datetime) else value
+        for value in values
+    ])
+
+    return urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, *types):
+    """Decode a cursor made by `encode_cursor` into values of `types`.
+
+    Raises BadRequest if the cursor is malformed.
+    """
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(urlsafe_b64decode(padded))
+
+        if len(values) != len(types):
+            raise ValueError("wrong number of cursor values")
+
+        return tuple(
+            datetime.fromisoformat(value) if kind is datetime else kind(value)
+            for kind, value in zip(types, values)
+        )
+
+    except (Base64Error, TypeError, ValueError):
+        raise BadRequest("Invalid cursor.")
+
+
+def keyset_page(query, per_page, key):
+    """Fetch one page of an already ordered and filtered `query`.
+
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    `key` maps a row to the values its cursor is built from.
+    """
+
+    return cut_page(query.limit(per_page + 1).all(), per_page, key)
+
+
+def cut_page(rows, per_page, key):
+    """Cut `rows`, the first per_page + 1 (or fewer) rows in order, to a page.
+
+    Returns (rows, next_cursor), as keyset_page does.
+    """
+
+    next_cursor = None
+
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(*key(rows[-1]))
+
+    return rows, next_cursor
+
+
+def merged_page(runs, per_page, key):
+    """Fetch one page by merging `runs`, lists of rows in the same order.
+
+    Each run must be sorted by `key` descending and hold at least the
+    first per_page + 1 rows of its stream (or all of them), so the merge is
+    the first rows of the combined stream; `key` must identify a row, and
+    rows found in more than one run are kept once. Returns (rows,
+    next_cursor), as keyset_page does.
+    """
+
+    rows = []
+    last_key = None
+
+    for row in heapq.merge(*runs, key=key, reverse=True):
+        row_key = key(row)
+        if row_key == last_key:
+            continue
+
+        rows.append(row)
+        last_key = row_key
+
+        if len(rows) > per_page:
+            break
+
+    return cut_page(rows, per_page, key)
@@ -0,0 +1,69 @@
+"""Password hashing for Warbler."""
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+# Matches the work factor in a bcrypt hash, e.g. the 12 in "$2b$12$..."
+BCRYPT_COST_RE = re.compile(r"^\$2[abxy]?\$(\d{2})\$")
+
+
+class PooledBcrypt(Bcrypt):
+    """Flask-Bcrypt that hashes on a bounded pool of worker threads.
+
+    bcrypt releases the GIL while hashing, so hashes run in parallel on the
+    pool, but never more of them at once than it has workers; a burst of
+    logins queues for a worker instead of every request thread competing
+    for CPU at the same time.
+
+    Settings (app.config):
+        BCRYPT_LOG_ROUNDS: work factor for new hashes (as in Flask-Bcrypt)
+        BCRYPT_WORKERS: size of the hashing pool (default: CPU count)
+    """
+
+    def __init__(self, app=None, workers=None):
+        self._executor = None
+        self.set_workers(workers or os.cpu_count())
+        super().__init__(app)
+
+    def init_app(self, app):
+        super().init_app(app)
+        self.set_workers(app.config.get('BCRYPT_WORKERS', os.cpu_count()))
+
+    @property
+    def log_rounds(self):
+        """Work factor used for new hashes."""
+
+        return self._log_rounds
+
+    def set_log_rounds(self, rounds):
+        """Change the work factor used for new hashes."""
+
+        self._log_rounds = rounds
+
+    def set_workers(self, workers):
+        """Replace the hashing pool with one of `workers` threads."""
+
+        old_executor = self._executor
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="bcrypt")
+
+        if old_executor:
+            old_executor.shutdown(wait=False)
+
+    def generate_password_hash(self, password, rounds=None, prefix=None):
+        generate = super().generate_password_hash
+        future = self._executor.submit(generate, password, rounds, prefix)
+        return future.result()
+
+    def check_password_hash(self, pw_hash, password):
+        check = super().check_password_hash
+        return self._executor.submit(check, pw_hash, password).result()
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a different work factor than configured?"""
+
+        match = BCRYPT_COST_RE.match(pw_hash)
+        return not match or int(match.group(1)) != self.log_rounds
@@ -1,19 +1,233 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Each table is loaded from generator/<table>.csv, or from chunk files named
+generator/<table>-*.csv, streamed into Postgres with COPY FROM STDIN.
+Secondary indexes and foreign key/unique constraints are dropped for the
+load and rebuilt afterwards, tables are loaded in parallel, and timelines
+and counters are derived from the loaded data at the end.
 
-db.drop_all()
-db.create_all()
+    python seed.py [--data-dir generator] [--workers 4]
+"""
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from pathlib import Path
+from time import perf_counter
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+from sqlalchemy import text
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+from app import app, db
+from migrations import upgrade
+from models import User, TimelineEntry
 
-db.session.commit()
+# Tables loaded from CSVs, in dependency order
+CSV_TABLES = ['users', 'messages', 'follows', 'likes']
+
+# Tables whose indexes and constraints are deferred until after loading
+DEFERRED_TABLES = CSV_TABLES + ['timeline_entries']
+
+# Tables with a serial id column
+SERIAL_TABLES = ['users', 'messages', 'likes']
+
+# Bytes per chunk streamed to COPY
+COPY_CHUNK_SIZE = 1 << 20
+
+
+def csv_files(data_dir, table):
+    """Return the CSV files to load into `table`, in order."""
+
+    single = Path(data_dir, f"{table}.csv")
+    chunks = sorted(glob(str(Path(data_dir, f"{table}-*.csv"))))
+
+    return ([str(single)] if single.exists() else []) + chunks
+
+
+def deferrable_ddl(conn):
+    """Return (drop, create) DDL statements for deferred indexes/constraints.
+
+    Definitions are read from the catalog, so this covers every secondary
+    index, including ones created outside the models' metadata.
+    """
+
+    constraints = conn.execute(text("""
+        SELECT conrelid::regclass::text, conname, contype,
+               pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid::regclass::text = ANY(:tables)
+          AND contype IN ('f', 'u')
+        ORDER BY contype = 'u'
+    """), {"tables": DEFERRED_TABLES}).all()
+
+    indexes = conn.execute(text("""
+        SELECT i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid)
+        FROM pg_index AS i
+        WHERE i.indrelid::regclass::text = ANY(:tables)
+          AND NOT EXISTS (
+              SELECT FROM pg_constraint AS c
+              WHERE c.conindid = i.indexrelid AND c.contype IN ('p', 'u', 'x')
+          )
+    """), {"tables": DEFERRED_TABLES}).all()
+
+    # Foreign keys go first and come back last; unique constraints back
+    # the foreign keys that reference them.
+    drop = [
+        f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'
+        for table, name, kind, definition in constraints
+    ] + [f'DROP INDEX "{name}"' for name, definition in indexes]
+
+    create = [definition for name, definition in indexes] + [
+        f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'
+        for table, name, kind, definition in reversed(constraints)
+    ]
+
+    return drop, create
+
+
+def copy_file(engine, table, path):
+    """Stream one CSV file into `table` with COPY; return rows loaded."""
+
+    conn = engine.raw_connection()
+
+    try:
+        with open(path, newline='') as csv_file:
+            columns = csv_file.readline().strip()
+            cursor = conn.cursor()
+            cursor.copy_expert(
+                f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)",
+                csv_file,
+                size=COPY_CHUNK_SIZE,
+            )
+            rows = cursor.rowcount
+
+        conn.commit()
+        return rows
+
+    finally:
+        conn.close()
+
+
+def copy_files(engine, table, paths):
+    """Stream CSV files into `table` one after another.
+
+    Returns (rows loaded, time finished). Runs on worker threads, so it's
+    handed the engine rather than using the app context's `db.engine`.
+    """
+
+    rows = sum(copy_file(engine, table, path) for path in paths)
+
+    return rows, perf_counter()
+
+
+def load_jobs(tables):
+    """Split each table's files into jobs that can run concurrently.
+
+    Files with explicit ids are separate jobs. Without ids, rows get ids in
+    file order from the table's sequence, so those files are one job.
+    """
+
+    for table, paths in tables.items():
+        with open(paths[0]) as first:
+            has_ids = "id" in first.readline().strip().split(",")
+
+        if has_ids:
+            for path in paths:
+                yield table, [path]
+        else:
+            yield table, paths
+
+
+def reset_sequences(conn):
+    """Point each serial id sequence past the highest loaded id."""
+
+    for table in SERIAL_TABLES:
+        conn.execute(text(f"""
+            SELECT setval(
+                pg_get_serial_sequence('{table}', 'id'),
+                coalesce(max(id), 0) + 1,
+                false
+            )
+            FROM {table}
+        """))
+
+
+def report(step, rows, seconds):
+    """Print how many rows a step handled, how long it took, and its rate."""
+
+    rate = f"{rows / seconds:,.0f} rows/s" if rows and seconds else ""
+    print(f"{step:<24} {rows:>12,} rows {seconds:>8.2f}s  {rate}")
+
+
+def seed(data_dir, workers):
+    db.drop_all()
+    db.create_all()
+
+    with db.engine.begin() as conn:
+        drop_ddl, create_ddl = deferrable_ddl(conn)
+        for statement in drop_ddl:
+            conn.execute(text(statement))
+
+    tables = {
+        table: csv_files(data_dir, table)
+        for table in CSV_TABLES
+        if csv_files(data_dir, table)
+    }
+
+    start = perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [
+            (table, executor.submit(copy_files, db.engine, table, paths))
+            for table, paths in load_jobs(tables)
+        ]
+
+        results = {}
+        for table, job in jobs:
+            rows, finished = job.result()
+            total, last_finished = results.get(table, (0, start))
+            results[table] = (total + rows, max(finished, last_finished))
+
+    for table, (rows, finished) in results.items():
+        report(f"load {table}", rows, finished - start)
+
+    total_rows = sum(rows for rows, finished in results.values())
+    report("load (all tables)", total_rows, perf_counter() - start)
+
+    with db.engine.begin() as conn:
+        reset_sequences(conn)
+
+    step_start = perf_counter()
+    timeline_rows = TimelineEntry.rebuild_all(
+        pull_threshold=app.config['TIMELINE_PULL_THRESHOLD'])
+    db.session.commit()
+    report("timelines", timeline_rows, perf_counter() - step_start)
+
+    step_start = perf_counter()
+    with db.engine.begin() as conn:
+        for statement in create_ddl:
+            conn.execute(text(statement))
+    report("indexes and constraints", 0, perf_counter() - step_start)
+
+    # Counting per user needs the indexes, so this comes after them
+    step_start = perf_counter()
+    User.reconcile_counts()
+    db.session.commit()
+    report("counters", 0, perf_counter() - step_start)
+
+    with db.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("ANALYZE"))
+
+    # Record the schema as fully migrated
+    upgrade(db.engine, log=lambda line: None)
+
+    report("total", total_rows, perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--data-dir", default="generator")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    seed(args.data_dir, args.workers)
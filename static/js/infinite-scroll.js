@@ -0,0 +1,46 @@
+"use strict";
+
+/** Load the next page of messages when the "Load more" link scrolls into
+ *  view, appending it to the list instead of navigating. Without JS, the
+ *  link still works as a plain link to the next page. */
+
+const loadMore = document.querySelector("a.load-more");
+const messageList = document.querySelector("#messages");
+
+if (loadMore && messageList && "IntersectionObserver" in window) {
+  let loading = false;
+
+  const observer = new IntersectionObserver(async function loadNextPage(
+    entries,
+  ) {
+    if (loading || !entries.some((entry) => entry.isIntersecting)) return;
+    loading = true;
+
+    const resp = await fetch(loadMore.href, {
+      headers: { "X-Fragment": "messages" },
+    });
+
+    // On failure, leave the link for the user to follow
+    if (!resp.ok) {
+      observer.disconnect();
+      return;
+    }
+
+    messageList.insertAdjacentHTML("beforeend", await resp.text());
+
+    const nextUrl = resp.headers.get("X-Next-Url");
+    if (nextUrl) {
+      loadMore.href = nextUrl;
+      // Observe afresh, in case the link is still in view
+      observer.unobserve(loadMore);
+      observer.observe(loadMore);
+    } else {
+      observer.disconnect();
+      loadMore.remove();
+    }
+
+    loading = false;
+  });
+
+  observer.observe(loadMore);
+}
@@ -0,0 +1,24 @@
+"use strict";
+
+/** Submit like buttons with fetch and update the heart in place, rather
+ *  than reloading the whole page. */
+
+document.addEventListener("submit", async function handleLike(evt) {
+  const form = evt.target.closest("form.like-form");
+  if (!form) return;
+
+  evt.preventDefault();
+
+  const resp = await fetch(form.action, {
+    method: "POST",
+    body: new FormData(form),
+    headers: { Accept: "application/json" },
+  });
+
+  if (!resp.ok) return;
+
+  const { liked } = await resp.json();
+  const icon = form.querySelector("i");
+  icon.classList.toggle("bi-heart-fill", liked);
+  icon.classList.toggle("bi-heart", !liked);
+});
@@ -0,0 +1,316 @@
+"""Cache backend tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+#
+# RedisCache is tested against StandInRedis, a small in-memory server
+# speaking enough of the Redis protocol for the cache, so no Redis server
+# is needed.
+
+import socketserver
+import threading
+from fnmatch import fnmatchcase
+from time import monotonic, sleep
+from unittest import TestCase
+
+from cache import LRUCache, RedisCache, RESPConnection, make_cache
+
+
+class StandInRedis(socketserver.ThreadingTCPServer):
+    """In-memory server for the commands RedisCache uses."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInRedisHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.commands = []
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"redis://{host}:{port}/0"
+
+    def live(self, key):
+        """Return the value of `key`, dropping it if it's expired."""
+
+        value, expires_at = self.data.get(key, (None, None))
+        if expires_at and expires_at <= monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def execute(self, name, *args):
+        self.commands.append(name)
+
+        with self.lock:
+            if name in (b'PING', b'AUTH', b'SELECT'):
+                return b'+OK'
+
+            if name == b'GET':
+                return self.live(args[0])
+
+            if name == b'SET':
+                key, value, *options = args
+                options = [option.upper() for option in options]
+                if b'NX' in options and self.live(key) is not None:
+                    return None
+
+                expires_at = None
+                if b'PX' in options:
+                    milliseconds = int(options[options.index(b'PX') + 1])
+                    expires_at = monotonic() + milliseconds / 1000
+
+                self.data[key] = (value, expires_at)
+                return b'+OK'
+
+            if name == b'DEL':
+                return sum(self.data.pop(key, None) is not None
+                           for key in args)
+
+            if name == b'SCAN':
+                pattern = args[args.index(b'MATCH') + 1].decode()
+                return [b'0', [key for key in list(self.data)
+                               if self.live(key) is not None
+                               and fnmatchcase(key.decode(), pattern)]]
+
+            if name == b'INFO':
+                return b'# Stats\r\nevicted_keys:7\r\n'
+
+        return Exception(f"ERR unknown command '{name.decode()}'")
+
+
+class StandInRedisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+
+            reply = self.server.execute(args[0].upper(), *args[1:])
+            self.wfile.write(self.encode(reply))
+
+    def encode(self, reply):
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, Exception):
+            return b'-%s\r\n' % str(reply).encode()
+        if isinstance(reply, int):
+            return b':%d\r\n' % reply
+        if isinstance(reply, list):
+            return b'*%d\r\n' % len(reply) + b''.join(
+                self.encode(item) for item in reply)
+        if reply.startswith(b'+'):
+            return reply + b'\r\n'
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+
+
+def run_concurrently(calls, threads=8):
+    """Run `calls` (functions) on `threads` threads started together."""
+
+    barrier = threading.Barrier(threads)
+    results = []
+
+    def worker(call):
+        barrier.wait()
+        results.append(call())
+
+    workers = [threading.Thread(target=worker, args=(calls[i % len(calls)],))
+               for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    return results
+
+
+def slow_compute(calls):
+    """Return a compute function that records its calls in `calls`."""
+
+    def compute():
+        calls.append(1)
+        sleep(0.05)
+        return {"computed": len(calls)}
+
+    return compute
+
+
+class LRUCacheTestCase(TestCase):
+    def test_hits_misses_evictions(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+
+        # "b" is now the least recently used
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+        metrics = cache.metrics()
+        self.assertEqual(
+            (metrics["hits"], metrics["misses"], metrics["evictions"]),
+            (2, 1, 1))
+        self.assertAlmostEqual(metrics["hit_rate"], 2 / 3)
+
+    def test_expiry(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+
+        cache.set("a", 1, ttl=0.01)
+        sleep(0.02)
+
+        self.assertEqual(cache.get("a", "missing"), "missing")
+        self.assertEqual(cache.metrics()["expirations"], 1)
+
+    def test_delete_many(self):
+        cache = LRUCache()
+        for key in "abc":
+            cache.set(key, key)
+
+        cache.delete_many(["a", "c", "missing"])
+
+        self.assertEqual([cache.get(key) for key in "abc"], [None, "b", None])
+
+    def test_caches_none(self):
+        cache = LRUCache()
+        calls = []
+
+        for _ in range(2):
+            cache.get_or_set("a", lambda: calls.append(1))
+
+        self.assertEqual(len(calls), 1)
+
+    def test_single_flight(self):
+        cache = LRUCache()
+        calls = []
+        compute = slow_compute(calls)
+
+        results = run_concurrently(
+            [lambda: cache.get_or_set("key", compute)])
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"computed": 1}] * 8)
+        self.assertEqual(cache.metrics()["waits"], 7)
+
+
+class RedisCacheTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StandInRedis()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.data.clear()
+        self.cache = RedisCache(self.server.url, name="test", ttl=60)
+
+    def test_round_trip(self):
+        self.cache.set((1, 0), {"username": "u1"})
+
+        self.assertEqual(self.cache.get((1, 0)), {"username": "u1"})
+        self.assertIsNone(self.cache.get((2, 0)))
+
+        self.cache.delete((1, 0))
+        self.assertIsNone(self.cache.get((1, 0)))
+
+        metrics = self.cache.metrics()
+        self.assertEqual((metrics["hits"], metrics["misses"]), (1, 2))
+        self.assertEqual(metrics["server_evictions"], 7)
+
+    def test_shared_between_workers(self):
+        other_worker = RedisCache(self.server.url, name="test", ttl=60)
+
+        self.cache.set("key", "value")
+        self.assertEqual(other_worker.get("key"), "value")
+
+        other_worker.delete("key")
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_delete_many_in_batches(self):
+        for i in range(5):
+            self.cache.set((i, 0), i)
+        self.server.commands.clear()
+
+        self.cache.delete_many([(i, 0) for i in range(4)], batch_size=2)
+
+        self.assertEqual(self.server.commands, [b'DEL', b'DEL'])
+        self.assertEqual([self.cache.get((i, 0)) for i in range(5)],
+                         [None, None, None, None, 4])
+
+    def test_ttl(self):
+        self.cache.set("key", "value", ttl=0.05)
+        sleep(0.1)
+
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_clear_only_own_entries(self):
+        other_cache = RedisCache(self.server.url, name="other", ttl=60)
+        self.cache.set("key", 1)
+        other_cache.set("key", 2)
+
+        self.cache.clear()
+
+        self.assertIsNone(self.cache.get("key"))
+        self.assertEqual(other_cache.get("key"), 2)
+
+    def test_single_flight_across_workers(self):
+        workers = [RedisCache(self.server.url, name="test", ttl=60)
+                   for _ in range(4)]
+        calls = []
+        compute = slow_compute(calls)
+
+        results = run_concurrently([
+            lambda worker=worker: worker.get_or_set("key", compute)
+            for worker in workers
+        ])
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"computed": 1}] * 8)
+
+    def test_connections_reused(self):
+        for _ in range(5):
+            self.cache.get("key")
+
+        self.assertEqual(len(self.cache._pool), 1)
+
+    def test_unreachable_server_acts_empty(self):
+        with socketserver.TCPServer(('127.0.0.1', 0), None) as closed:
+            host, port = closed.server_address
+        cache = RedisCache(f"redis://{host}:{port}", name="test", ttl=60)
+
+        cache.set("key", "value")
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.get_or_set("key", lambda: "computed"),
+                         "computed")
+        self.assertGreater(cache.metrics()["errors"], 0)
+
+    def test_error_reply(self):
+        conn = RESPConnection(self.server.server_address, 1.0)
+        try:
+            with self.assertRaises(Exception):
+                conn.command("FLUSHALL")
+            self.assertEqual(conn.command("PING"), "OK")
+        finally:
+            conn.close()
+
+    def test_make_cache(self):
+        self.assertIsInstance(make_cache(None, "local-test"), LRUCache)
+        self.assertIsInstance(
+            make_cache(self.server.url, "shared-test"), RedisCache)
+
+        with self.assertRaises(ValueError):
+            make_cache("memcached://localhost", "bad-test")
@@ -1,9 +1,12 @@
 """Message model tests."""
 
 import os
+from datetime import datetime
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
-from models import db, User, Message, Like
+from models import db, User, Message, Like, Follows, TimelineEntry
+from migrations import explain_checks
+from pagination import decode_cursor
 
 # Environmental variable for URL
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
@@ -131,4 +134,179 @@ class MessageModelTestCase(TestCase):
         with self.assertRaises(IntegrityError):
             like = Like(user_id=self.u2_id, message_id=1000)
             db.session.add(like)
-            db.session.commit()
\ No newline at end of file
+            db.session.commit()
+
+    def test_message_likes_unique(self):
+        """Test that a user cannot like the same message twice"""
+
+        db.session.add(Like(user_id=self.u2_id, message_id=self.m1_id))
+        db.session.commit()
+
+        with self.assertRaises(IntegrityError):
+            db.session.add(Like(user_id=self.u2_id, message_id=self.m1_id))
+            db.session.commit()
+
+    ########################################################################
+    # Index usage tests
+
+    def test_key_queries_use_indexes(self):
+        """Test that the hot queries are planned with their indexes"""
+
+        users = [
+            User(username=f"user{i}", email=f"user{i}@email.com",
+                 password="password")
+            for i in range(20)
+        ]
+        db.session.add_all(users)
+        db.session.flush()
+
+        for i, user in enumerate(users):
+            followed = users[(i + 1) % len(users)]
+            db.session.add(Follows(user_being_followed_id=followed.id,
+                                   user_following_id=user.id))
+            for j in range(5):
+                msg = Message(text=f"message {j}", user_id=user.id)
+                db.session.add(msg)
+                db.session.flush()
+                for k in range(1, 5):
+                    liker = users[(i + k) % len(users)]
+                    db.session.add(Like(user_id=liker.id, message_id=msg.id))
+
+        db.session.flush()
+        for user in users:
+            TimelineEntry.rebuild(user.id)
+        db.session.commit()
+
+        db.session.execute(db.text("ANALYZE"))
+        db.session.commit()
+
+        for name, index, used in explain_checks(db.session):
+            self.assertTrue(used, f"{name} does not use {index}")
+
+
+class HybridTimelineTestCase(TestCase):
+    def setUp(self):
+        """Create a viewer following an ordinary and a popular author"""
+
+        User.query.delete()
+
+        viewer, ordinary, popular, fan = [
+            User.signup(name, f"{name}@email.com", "password", None)
+            for name in ["viewer", "ordinary", "popular", "fan"]
+        ]
+        db.session.flush()
+
+        Follows.follow(viewer.id, [ordinary.id, popular.id])
+        Follows.follow(fan.id, [popular.id])
+
+        # Fanned out before the popular author reached the threshold
+        self.post(popular, 0)
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.fan_id = fan.id
+        self.ordinary = ordinary
+        self.popular = popular
+
+    def tearDown(self):
+        """Clean up fouled transactions"""
+
+        db.session.rollback()
+
+    def post(self, author, minute, pull_threshold=None):
+        msg = Message(text=f"{author.username} {minute}", user_id=author.id,
+                      timestamp=datetime(2023, 1, 1, 0, minute))
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg, pull_threshold=pull_threshold)
+
+        return msg
+
+    def post_interleaved(self):
+        for minute in range(1, 7):
+            author = self.popular if minute % 2 else self.ordinary
+            self.post(author, minute, pull_threshold=2)
+        db.session.commit()
+
+    def read_timeline(self, user_id, per_page):
+        seen = []
+        before = None
+        while True:
+            messages, next_cursor = TimelineEntry.page_for(
+                user_id, per_page, before=before)
+            seen += [msg.text for msg in messages]
+            if not next_cursor:
+                return seen
+            before = decode_cursor(next_cursor, datetime, int)
+
+    def test_popular_author_not_fanned_out(self):
+        """Test posting at the threshold switches the author to pulled"""
+
+        msg = self.post(self.popular, 1, pull_threshold=2)
+        db.session.commit()
+
+        self.assertTrue(User.query.get(self.popular.id).timeline_pull)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(message_id=msg.id).count(), 1)
+
+    def test_fan_out_returns_timelines(self):
+        """Test fan_out reports the timelines it added the message to"""
+
+        msg = Message(text="ordinary 1", user_id=self.ordinary.id)
+        db.session.add(msg)
+        db.session.flush()
+        self.assertEqual(
+            sorted(TimelineEntry.fan_out(msg, pull_threshold=2)),
+            sorted([self.ordinary.id, self.viewer_id]))
+        self.assertFalse(
+            TimelineEntry.follows_pulled_authors(self.viewer_id))
+
+        msg = Message(text="popular 1", user_id=self.popular.id)
+        db.session.add(msg)
+        db.session.flush()
+        self.assertEqual(
+            TimelineEntry.fan_out(msg, pull_threshold=2), [self.popular.id])
+        self.assertTrue(TimelineEntry.follows_pulled_authors(self.viewer_id))
+
+    def test_page_for_merges_pulled_messages(self):
+        """Test timelines merge pushed and pulled messages, newest first"""
+
+        self.post_interleaved()
+
+        expected = (
+            [f"{'popular' if m % 2 else 'ordinary'} {m}"
+             for m in range(6, 0, -1)]
+            + ["popular 0"])
+
+        for per_page in [1, 2, 3, 100]:
+            self.assertEqual(
+                self.read_timeline(self.viewer_id, per_page), expected)
+
+    def test_follow_pulled_author(self):
+        """Test following a pulled author shows them without copying"""
+
+        self.post_interleaved()
+        newcomer = User.signup("newcomer", "n@email.com", "password", None)
+        db.session.flush()
+        Follows.follow(newcomer.id, [self.popular.id])
+        db.session.commit()
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=newcomer.id).count(), 0)
+        self.assertEqual(
+            self.read_timeline(newcomer.id, 2),
+            ["popular 5", "popular 3", "popular 1", "popular 0"])
+
+    def test_push_author(self):
+        """Test switching an author back copies their messages"""
+
+        self.post_interleaved()
+        before = self.read_timeline(self.fan_id, 2)
+
+        TimelineEntry.push_author(self.popular.id)
+        db.session.commit()
+
+        self.assertFalse(User.query.get(self.popular.id).timeline_pull)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.fan_id).count(), 4)
+        self.assertEqual(self.read_timeline(self.fan_id, 2), before)
@@ -6,9 +6,15 @@
 
 
 import os
+import re
+from html import unescape
+from contextlib import contextmanager
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, Message, User
+from sqlalchemy import event
+
+from models import db, Message, User, Like, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,7 +25,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, fragment_cache, user_counts
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -39,6 +45,22 @@ db.create_all()
 app.config['WTF_CSRF_ENABLED'] = False
 
 
+@contextmanager
+def count_statements():
+    """Collect the SQL statements issued inside the `with` block."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+
 class MessageBaseViewTestCase(TestCase):
     def setUp(self):
         User.query.delete()
@@ -71,3 +93,537 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertEqual(resp.status_code, 302)
 
             Message.query.filter_by(text="Hello").one()
+
+    def test_add_message_loads_no_messages(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.get("/messages/new")
+
+            with count_statements() as statements:
+                c.post("/messages/new", data={"text": "Hello"})
+
+            # Neither the author's other messages nor their whole row
+            self.assertFalse(
+                [s for s in statements
+                 if s.lstrip().startswith("SELECT")
+                 and ("FROM messages" in s or "users.password" in s)],
+                "\n".join(statements))
+
+    def test_add_message_fans_out_to_followers(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u2.following.append(User.query.get(self.u1_id))
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "Hello followers"})
+            msg = Message.query.filter_by(text="Hello followers").one()
+
+            for user_id in [self.u1_id, u2_id]:
+                timeline = TimelineEntry.messages_for(user_id).all()
+                self.assertEqual(timeline, [msg])
+
+
+    def test_add_message_refreshes_followers_cached_homepage(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u2.following.append(User.query.get(self.u1_id))
+        db.session.commit()
+        u2_id = u2.id
+
+        follower = app.test_client()
+        with follower.session_transaction() as sess:
+            sess[CURR_USER_KEY] = u2_id
+        self.assertNotIn(
+            "Hello followers", follower.get("/").get_data(as_text=True))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post("/messages/new", data={"text": "Hello followers"})
+
+        self.assertIn(
+            "Hello followers", follower.get("/").get_data(as_text=True))
+
+    def test_new_message_form_uses_cached_user(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/messages/new")
+            db.session.expunge_all()
+
+            with count_statements() as statements:
+                resp = c.get("/messages/new")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('alt="u1"', resp.get_data(as_text=True))
+            self.assertEqual(statements, [])
+
+
+class MessageLikeStateViewTestCase(MessageBaseViewTestCase):
+    def test_liked_state_on_profile(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+        m2 = Message(text="m2-text", user_id=u2.id)
+        m3 = Message(text="m3-text", user_id=u2.id)
+        db.session.add_all([m2, m3])
+        db.session.flush()
+        db.session.add(Like(user_id=self.u1_id, message_id=m2.id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f"/users/{u2.id}").get_data(as_text=True)
+            self.assertEqual(html.count("bi-heart-fill"), 1)
+            self.assertEqual(html.count('class="bi bi-heart"'), 1)
+
+            # Own messages have no like button
+            html = c.get(f"/users/{self.u1_id}").get_data(as_text=True)
+            self.assertNotIn(f"/messages/{self.m1_id}/like", html)
+
+
+class MessageLikeToggleViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        self.u2_id = u2.id
+
+    def test_like_toggle_json(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            headers = {"Accept": "application/json"}
+
+            with count_statements() as statements:
+                resp = c.post(f"/messages/{self.m1_id}/like", headers=headers)
+
+            self.assertEqual(resp.json, {
+                "message_id": self.m1_id, "liked": True, "like_count": 1})
+            # One statement touches the likes table for the whole toggle
+            self.assertEqual(
+                len([s for s in statements if re.search(r"\blikes\b", s)]),
+                1)
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+
+            resp = c.post(f"/messages/{self.m1_id}/like", headers=headers)
+            self.assertEqual(resp.json, {
+                "message_id": self.m1_id, "liked": False, "like_count": 0})
+
+            db.session.expire_all()
+            self.assertEqual(User.query.get(self.u2_id).likes_count, 0)
+            self.assertEqual(Like.query.count(), 0)
+
+    def test_like_toggle_redirects_without_json(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post(f"/messages/{self.m1_id}/like",
+                          headers={"Referer": "/"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Like.query.count(), 1)
+
+    def test_like_own_message_forbidden(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post(f"/messages/{self.m1_id}/like")
+            self.assertEqual(resp.status_code, 403)
+            self.assertEqual(Like.query.count(), 0)
+
+    def test_like_missing_message(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post("/messages/0/like")
+            self.assertEqual(resp.status_code, 404)
+
+
+class MessageCardCacheViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+        fragment_cache.clear()
+
+    def show_profile(self, client):
+        return client.get(f"/users/{self.u1_id}").get_data(as_text=True)
+
+    def test_card_served_from_cache(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertIn("m1-text", self.show_profile(c))
+
+            # Changed behind the cache's back, so the cached card is shown
+            Message.query.get(self.m1_id).text = "changed"
+            db.session.commit()
+
+            self.assertIn("m1-text", self.show_profile(c))
+
+    def test_profile_edit_invalidates_cards(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.assertIn("@u1<", self.show_profile(c))
+
+            resp = c.post("/users/edit-profile", data={
+                "username": "u1-renamed",
+                "email": "u1@email.com",
+                "password": "password",
+            })
+            self.assertEqual(resp.status_code, 302)
+
+            self.assertIn("@u1-renamed<", self.show_profile(c))
+
+    def test_delete_message_invalidates_card(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            self.show_profile(c)
+            self.assertIsNotNone(fragment_cache.get((self.m1_id, 0)))
+
+            c.post(f"/messages/{self.m1_id}/delete")
+
+            self.assertIsNone(fragment_cache.get((self.m1_id, 0)))
+
+    def test_delete_message_invalidates_likers_counts(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+        db.session.add(Like(user_id=u2.id, message_id=self.m1_id))
+        User.adjust_counts([u2.id], likes_count=1)
+        db.session.commit()
+        u2_id = u2.id
+
+        self.assertEqual(user_counts(u2_id)["likes_count"], 1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.post(f"/messages/{self.m1_id}/delete")
+
+        self.assertEqual(user_counts(u2_id)["likes_count"], 0)
+
+    def test_like_button_not_cached(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            self.assertIn("bi-heart\"", self.show_profile(c))
+
+            c.post(f"/messages/{self.m1_id}/like")
+
+            self.assertIn("bi-heart-fill", self.show_profile(c))
+
+
+class LikedMessagesViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        older = Message(text="older-msg", user_id=self.u1_id,
+                        timestamp=datetime(2022, 1, 1))
+        newer = Message(text="newer-msg", user_id=self.u1_id,
+                        timestamp=datetime(2023, 1, 1))
+        db.session.add_all([older, newer])
+        db.session.flush()
+
+        # Liked in the opposite order to when they were written
+        db.session.add_all([
+            Like(user_id=u2.id, message_id=newer.id,
+                 created_at=datetime(2023, 2, 1)),
+            Like(user_id=u2.id, message_id=older.id,
+                 created_at=datetime(2023, 3, 1)),
+        ])
+        db.session.commit()
+
+        self.u2_id = u2.id
+        app.config['MESSAGES_PER_PAGE'] = 1
+
+    def tearDown(self):
+        app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_liked_messages_by_like_time(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            seen = []
+            url = f"/users/{self.u2_id}/liked-messages"
+            while url:
+                html = c.get(url).get_data(as_text=True)
+                seen += re.findall(r"\w+-msg", html)
+                match = re.search(
+                    r'href="(/users/\d+/liked-messages\?before=[^"]+)"', html)
+                url = match and match.group(1)
+
+            self.assertEqual(seen, ["older-msg", "newer-msg"])
+
+    def test_like_records_time(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/messages/{self.m1_id}/like")
+
+        like = Like.query.filter_by(
+            user_id=self.u2_id, message_id=self.m1_id).one()
+        self.assertLess(
+            abs(datetime.utcnow() - like.created_at).total_seconds(), 60)
+
+
+class HomepagePaginationTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Same timestamp for every message, so ties are broken by id
+        timestamp = datetime(2023, 1, 1)
+        for i in range(5):
+            msg = Message(text=f"page-msg-{i}", user_id=self.u1_id,
+                          timestamp=timestamp)
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+        db.session.commit()
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+    def tearDown(self):
+        app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_homepage_cursor_pages(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            seen = []
+            url = "/"
+            while url:
+                html = c.get(url).get_data(as_text=True)
+                seen += re.findall(r"page-msg-\d", html)
+                match = re.search(r'href="(/\?before=[^"]+)"', html)
+                url = match and match.group(1)
+
+            self.assertEqual(
+                seen, [f"page-msg-{i}" for i in reversed(range(5))])
+
+    def test_profile_cursor_pages(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            seen = []
+            url = f"/users/{self.u1_id}"
+            while url:
+                html = c.get(url).get_data(as_text=True)
+                seen += re.findall(r"page-msg-\d", html)
+                match = re.search(r'href="(/users/\d+\?before=[^"]+)"', html)
+                url = match and match.group(1)
+
+            self.assertEqual(
+                seen, [f"page-msg-{i}" for i in reversed(range(5))])
+
+    def test_infinite_scroll_fragment(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get("/").get_data(as_text=True)
+            next_url = unescape(
+                re.search(r'href="(/\?before=[^"]+)"', html).group(1))
+
+            resp = c.get(next_url, headers={"X-Fragment": "messages"})
+            fragment = resp.get_data(as_text=True)
+
+            self.assertNotIn("<html", fragment)
+            self.assertEqual(
+                re.findall(r"page-msg-\d", fragment),
+                ["page-msg-2", "page-msg-1"])
+            self.assertIn("X-Fragment", resp.headers["Vary"])
+
+            resp = c.get(resp.headers["X-Next-Url"],
+                         headers={"X-Fragment": "messages"})
+            self.assertIn("page-msg-0", resp.get_data(as_text=True))
+
+    def test_homepage_invalid_cursor(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+
+class ApiMessagesViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u2.following.append(User.query.get(self.u1_id))
+        db.session.flush()
+
+        timestamp = datetime(2023, 1, 1)
+        for i in range(5):
+            msg = Message(text=f"api-msg-{i}", user_id=self.u1_id,
+                          timestamp=timestamp)
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+
+        db.session.add(Like(user_id=u2.id, message_id=msg.id))
+        db.session.commit()
+
+        self.u2_id = u2.id
+        self.liked_id = msg.id
+
+    def tearDown(self):
+        app.config['API_FAST_JSON'] = True
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u2_id
+
+    def test_timeline_cursor_pages(self):
+        with self.client as c:
+            self.login(c)
+
+            seen = []
+            params = {"limit": 2, "fields": "text"}
+            while True:
+                body = c.get("/api/v1/timeline", query_string=params).json
+                self.assertLessEqual(len(body["data"]), 2)
+                seen += [message["text"] for message in body["data"]]
+                if not body["next_cursor"]:
+                    break
+                params["before"] = body["next_cursor"]
+
+            self.assertEqual(
+                seen, [f"api-msg-{i}" for i in reversed(range(5))])
+
+    def test_user_messages(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get(f"/api/v1/users/{self.u1_id}/messages")
+            messages = {
+                message["id"]: message for message in resp.json["data"]}
+            liked = messages[self.liked_id]
+
+            self.assertEqual(resp.content_type, "application/json")
+            self.assertEqual(len(messages), 6)
+            self.assertEqual(liked["timestamp"], "2023-01-01T00:00:00")
+            self.assertEqual(liked["author"]["username"], "u1")
+            self.assertTrue(liked["liked"])
+            self.assertFalse(messages[self.m1_id]["liked"])
+            self.assertIsNone(resp.json["next_cursor"])
+
+    def test_field_selection(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/api/v1/timeline?fields=id,liked")
+            self.assertEqual(
+                [set(message) for message in resp.json["data"]],
+                [{"id", "liked"}] * 5)
+
+            resp = c.get("/api/v1/timeline?fields=id,password")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("password", resp.json["error"])
+
+    def test_fallback_serializer_matches(self):
+        with self.client as c:
+            self.login(c)
+
+            fast = c.get(f"/api/v1/users/{self.u1_id}/messages").json
+            app.config['API_FAST_JSON'] = False
+            fallback = c.get(f"/api/v1/users/{self.u1_id}/messages").json
+
+            self.assertEqual(fast, fallback)
+
+    def test_errors_as_json(self):
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.json, {"error": "Access unauthorized."})
+
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/api/v1/users/0/messages")
+            self.assertEqual(resp.status_code, 404)
+            self.assertIn("error", resp.json)
+
+            resp = c.get("/api/v1/timeline?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json, {"error": "Invalid cursor."})
+
+
+class MessageListQueryCountTestCase(MessageBaseViewTestCase):
+    # Upper bound on statements for any page listing messages; must not
+    # grow with the number of messages, authors or likes on the page
+    MAX_STATEMENTS = 6
+
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.query.get(self.u1_id)
+        self.m_ids = []
+
+        for i in range(5):
+            author = User(username=f"author{i}", email=f"a{i}@email.com",
+                          password="password")
+            u1.following.append(author)
+            db.session.flush()
+
+            for j in range(2):
+                msg = Message(text=f"msg {i}-{j}", user_id=author.id)
+                db.session.add(msg)
+                db.session.flush()
+                TimelineEntry.fan_out(msg)
+                db.session.add(Like(user_id=self.u1_id, message_id=msg.id))
+                self.m_ids.append(msg.id)
+
+        db.session.commit()
+
+    def assert_statements_bounded(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with count_statements() as statements:
+                resp = c.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertLessEqual(
+                len(statements), self.MAX_STATEMENTS, "\n".join(statements))
+
+    def test_homepage_statements(self):
+        self.assert_statements_bounded("/")
+
+    def test_liked_messages_statements(self):
+        self.assert_statements_bounded(f"/users/{self.u1_id}/liked-messages")
+
+    def test_profile_statements(self):
+        author_id = Message.query.get(self.m_ids[0]).user_id
+        self.assert_statements_bounded(f"/users/{author_id}")
+
+    def test_message_detail_statements(self):
+        self.assert_statements_bounded(f"/messages/{self.m_ids[0]}")
+
+    def test_api_timeline_statements(self):
+        self.assert_statements_bounded("/api/v1/timeline")
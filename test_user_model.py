@@ -5,7 +5,9 @@ from sqlalchemy.exc import IntegrityError
 from unittest import TestCase
 from flask_bcrypt import Bcrypt
 
-from models import db, User
+import models
+from models import db, User, bcrypt as pooled_bcrypt
+from pagination import decode_cursor
 
 # Environmental variable for URL
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
@@ -115,6 +117,22 @@ class UserModelTestCase(TestCase):
         self.assertTrue(u2.is_following(u1))
         self.assertFalse(u1.is_following(u2))
 
+    def test_following_status(self):
+        """Test following_status returns only ids the user follows"""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.assertEqual(
+            u1.following_status([self.u1_id, self.u2_id, 1000]),
+            {self.u2_id}
+        )
+        self.assertEqual(u2.following_status([self.u1_id]), set())
+        self.assertEqual(u1.following_status([]), set())
+
     ########################################################################
     # User.signup tests
 
@@ -180,6 +198,33 @@ class UserModelTestCase(TestCase):
     ########################################################################
     # User.authenticate tests
 
+    def test_search_page_substring_matches_bounded(self):
+        """Test substring matches only fill pages prefix matches don't, from
+        a bounded set of candidates"""
+
+        for name in ["abc", "xabc", "yabc"]:
+            User.signup(name, f"{name}@email.com", "password", None)
+        db.session.commit()
+
+        rows, next_cursor = User.search_page("ABC", 1)
+        self.assertEqual([(row.User.username, row.rank) for row in rows],
+                         [("abc", 0)])
+
+        after = decode_cursor(next_cursor, int, str, int)
+        rows, next_cursor = User.search_page("abc", 1, after=after)
+        self.assertEqual([(row.User.username, row.rank) for row in rows],
+                         [("xabc", 2)])
+        self.assertIsNotNone(next_cursor)
+
+        models.SEARCH_SUBSTRING_CANDIDATES = 1
+
+        try:
+            rows, next_cursor = User.search_page("abc", 5)
+            self.assertEqual(len(rows), 2)
+            self.assertIsNone(next_cursor)
+        finally:
+            models.SEARCH_SUBSTRING_CANDIDATES = 1000
+
     def test_user_authenticate_valid(self):
         """Test successful return of user with correct username and password"""
 
@@ -200,4 +245,28 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(
             User.authenticate(username="u1", password="badpassword")
-        )
\ No newline at end of file
+        )
+
+    def test_user_authenticate_rehashes_password(self):
+        """Test login rehashes a password made with another work factor"""
+
+        log_rounds = pooled_bcrypt.log_rounds
+        pooled_bcrypt.set_log_rounds(4)
+
+        try:
+            user = User.authenticate(username="u1", password="password")
+            self.assertTrue(user.password.startswith("$2b$04$"))
+            self.assertFalse(pooled_bcrypt.needs_rehash(user.password))
+
+            # Saved by the caller's commit, not by authenticate
+            self.assertIn(user, db.session.dirty)
+            db.session.commit()
+            db.session.expire_all()
+            self.assertTrue(
+                User.query.get(user.id).password.startswith("$2b$04$"))
+
+            # The new hash still authenticates
+            self.assertEqual(
+                User.authenticate(username="u1", password="password"), user)
+        finally:
+            pooled_bcrypt.set_log_rounds(log_rounds)
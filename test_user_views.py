@@ -1,10 +1,19 @@
 """User view function tests."""
 
+import json
 import os
+import re
+from html import unescape
 from unittest import TestCase
-from sqlalchemy.exc import IntegrityError
-from models import db, User, Message, Like
-from app import CURR_USER_KEY
+from flask import g
+from sqlalchemy.exc import IntegrityError, ProgrammingError
+from datetime import datetime, timedelta
+from models import (
+    db, User, Message, Like, Follows, TimelineEntry, AccountDeletion
+)
+from deletion import request_deletion, run_worker
+from app import CURR_USER_KEY, counter_cache
+from instrumentation import endpoint_stats, reset_endpoint_stats
 
 # Environmental variable for URL
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
@@ -101,6 +110,58 @@ class UserRoutesTestCase(TestCase):
             self.assertIn("u2", html)
 
 
+    def test_list_users_search_ranking(self):
+        """Test search ranks exact, then prefix, then substring matches"""
+
+        for name in ["abc", "abcd", "xabc", "yabcz"]:
+            User.signup(name, f"{name}@email.com", "password", None)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            html = client.get("/users?q=ABC").get_data(as_text=True)
+
+            found = re.findall(r"<p>@(\w+)</p>", html)
+            self.assertEqual(found, ["abc", "abcd", "xabc", "yabcz"])
+
+            # short terms only match as a prefix
+            html = client.get("/users?q=u").get_data(as_text=True)
+            found = re.findall(r"<p>@(\w+)</p>", html)
+            self.assertEqual(found, ["u1", "u2"])
+
+    def test_list_users_pages(self):
+        """Test user listing and search page with an 'after' cursor"""
+
+        for name in ["u10", "u11", "u12", "xu110", "xu11", "yu11"]:
+            User.signup(name, f"{name}@email.com", "password", None)
+        db.session.commit()
+        app.config['USERS_PER_PAGE'] = 2
+
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                for url, expected in [
+                    ("/users", ["u1", "u2", "u10", "u11", "u12", "xu110",
+                                "xu11", "yu11"]),
+                    ("/users?q=u1", ["u1", "u10", "u11", "u12"]),
+                    # pages running from prefix into substring matches
+                    ("/users?q=u11", ["u11", "xu11", "xu110", "yu11"]),
+                ]:
+                    found = []
+                    while url:
+                        html = client.get(url).get_data(as_text=True)
+                        found += re.findall(r"<p>@(\w+)</p>", html)
+                        match = re.search(
+                            r'href="(/users\?[^"]*after=[^"]+)"', html)
+                        url = match and unescape(match.group(1))
+
+                    self.assertEqual(found, expected)
+        finally:
+            app.config['USERS_PER_PAGE'] = 48
+
     def test_show_user(self):
         """Test page showing user profile"""
 
@@ -114,6 +175,64 @@ class UserRoutesTestCase(TestCase):
             self.assertIn("<!-- Test: show page -->", html)
 
 
+    def test_show_user_conditional_get(self):
+        """Test profile answers 304 until something on it changes"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(f"/users/{self.u2_id}")
+            etag = resp.headers["ETag"]
+            self.assertTrue(etag.startswith('W/"'))
+            self.assertIn("no-cache", resp.headers["Cache-Control"])
+            self.assertIn("private", resp.headers["Cache-Control"])
+
+            resp = client.get(
+                f"/users/{self.u2_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            client.post(f"/users/follow/{self.u2_id}")
+
+            resp = client.get(
+                f"/users/{self.u2_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_homepage_conditional_get_after_like(self):
+        """Test liking a message changes the homepage's ETag"""
+
+        message = Message(text="u2-text", user_id=self.u2_id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post(f"/users/follow/{self.u2_id}")
+            etag = client.get("/").headers["ETag"]
+
+            resp = client.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            client.post(f"/messages/{message_id}/like")
+
+            resp = client.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("bi-heart-fill", resp.get_data(as_text=True))
+
+    def test_forms_not_stored(self):
+        """Test pages without a cache policy still aren't stored"""
+
+        with app.test_client() as client:
+            resp = client.get("/login")
+            self.assertIn("no-store", resp.headers["Cache-Control"])
+            self.assertNotIn("ETag", resp.headers)
+
     def test_show_following_logged_in(self):
         """Test page showing people user is following if logged in"""
 
@@ -126,6 +245,99 @@ class UserRoutesTestCase(TestCase):
             self.assertIn("<!-- Test: following page -->", html)
 
 
+    def test_followers_and_following_pages(self):
+        """Test follow lists page by id and skip deleted users"""
+
+        users = [User.signup(f"f{i}", f"f{i}@email.com", "password", None)
+                 for i in range(5)]
+        db.session.commit()
+        follower_ids = [user.id for user in users]
+
+        for user_id in follower_ids:
+            Follows.follow(user_id, [self.u1_id])
+            Follows.follow(self.u1_id, [user_id])
+        request_deletion(follower_ids[-1])
+        db.session.commit()
+
+        app.config['USERS_PER_PAGE'] = 2
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                for page in ["followers", "following"]:
+                    seen = []
+                    url = f"/users/{self.u1_id}/{page}"
+                    while url:
+                        html = client.get(url).get_data(as_text=True)
+                        seen += re.findall(r"@(f\d)", html)
+                        match = re.search(
+                            r'href="(/users/\d+/\w+\?after=[^"]+)"', html)
+                        url = match and unescape(match.group(1))
+
+                    self.assertEqual(seen, ["f0", "f1", "f2", "f3"])
+        finally:
+            app.config['USERS_PER_PAGE'] = 48
+
+    def test_api_follow_lists(self):
+        """Test the JSON follow lists page by cursor, with follow state"""
+
+        users = [User.signup(f"f{i}", f"f{i}@email.com", "password", None)
+                 for i in range(3)]
+        db.session.commit()
+
+        for user in users:
+            Follows.follow(user.id, [self.u1_id])
+        Follows.follow(self.u2_id, [users[1].id])
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            seen = []
+            params = {"limit": 2, "fields": "username,following"}
+            while True:
+                body = client.get(f"/api/v1/users/{self.u1_id}/followers",
+                                  query_string=params).json
+                seen += [(user["username"], user["following"])
+                         for user in body["data"]]
+                if not body["next_cursor"]:
+                    break
+                params["after"] = body["next_cursor"]
+
+            self.assertEqual(
+                seen, [("f0", False), ("f1", True), ("f2", False)])
+
+            resp = client.get(f"/api/v1/users/{self.u2_id}/following")
+            self.assertEqual(
+                [user["username"] for user in resp.json["data"]], ["f1"])
+
+    def test_api_search_users(self):
+        """Test the JSON user search ranks and pages like the HTML one"""
+
+        for name in ["abc", "xabc", "abcd"]:
+            User.signup(name, f"{name}@email.com", "password", None)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            seen = []
+            params = {"q": "abc", "limit": 2, "fields": "username"}
+            while True:
+                body = client.get("/api/v1/users", query_string=params).json
+                self.assertEqual(
+                    [set(user) for user in body["data"]],
+                    [{"username"}] * len(body["data"]))
+                seen += [user["username"] for user in body["data"]]
+                if not body["next_cursor"]:
+                    break
+                params["after"] = body["next_cursor"]
+
+            self.assertEqual(seen, ["abc", "abcd", "xabc"])
+
     def test_show_following_logged_out(self):
         """Test following page is blocked if not logged in"""
 
@@ -173,3 +385,418 @@ class UserRoutesTestCase(TestCase):
             u2 = User.query.get(self.u2_id)
             self.assertEqual(u2.followers, [u1])
 
+    def test_start_following_idempotent(self):
+        """Test following the same user twice keeps a single follow"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            client.post(f"/users/follow/{self.u2_id}")
+            resp = client.post(f"/users/follow/{self.u2_id}")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+
+    def test_start_following_missing_user(self):
+        """Test following a user who does not exist is a 404"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            resp = client.post("/users/follow/0")
+
+            self.assertEqual(resp.status_code, 404)
+
+    def test_stop_following_not_followed(self):
+        """Test unfollowing a user who is not followed is a no-op"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for user_id in [self.u2_id, 0]:
+                resp = client.post(f"/users/stop-following/{user_id}")
+                self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+
+    def test_bulk_follow(self):
+        """Test following several users in one request"""
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.commit()
+        u3_id = u3.id
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            resp = client.post(
+                "/users/follow",
+                data={"user_ids": [self.u2_id, u3_id, self.u1_id, 0]},
+                headers={"Accept": "application/json"},
+            )
+
+            self.assertEqual(
+                sorted(resp.json["followed"]), sorted([self.u2_id, u3_id]))
+
+            u1 = User.query.get(self.u1_id)
+            self.assertEqual(u1.following_count, 2)
+            self.assertEqual(
+                u1.following_status([self.u2_id, u3_id]), {self.u2_id, u3_id})
+
+    def test_start_following_backfills_timeline(self):
+        """Test following a user adds their messages to follower's timeline"""
+
+        m1 = Message(text="u2 message", user_id=self.u2_id)
+        db.session.add(m1)
+        db.session.commit()
+        m1_id = m1.id
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            client.post(f"/users/follow/{self.u2_id}")
+
+            timeline = TimelineEntry.messages_for(self.u1_id).all()
+            self.assertEqual([m.id for m in timeline], [m1_id])
+
+            resp = client.get("/")
+            self.assertIn("u2 message", resp.get_data(as_text=True))
+
+    def test_following_refreshes_cached_homepage(self):
+        """Test following shows on the homepage, though it was cached"""
+
+        m1 = Message(text="u2 message", user_id=self.u2_id)
+        db.session.add(m1)
+        db.session.commit()
+
+        def following_count(html):
+            return int(re.search(
+                r'/following">\s*(\d+)', html).group(1))
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            # Twice, so the profile, counters and timeline are cached
+            client.get("/")
+            html = client.get("/").get_data(as_text=True)
+            self.assertEqual(following_count(html), 0)
+            self.assertNotIn("u2 message", html)
+
+            client.post(f"/users/follow/{self.u2_id}")
+
+            html = client.get("/").get_data(as_text=True)
+            self.assertEqual(following_count(html), 1)
+            self.assertIn("u2 message", html)
+
+    def test_stop_following_prunes_timeline(self):
+        """Test unfollowing a user removes their messages from timeline"""
+
+        m1 = Message(text="u2 message", user_id=self.u2_id)
+        db.session.add(m1)
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            client.post(f"/users/follow/{self.u2_id}")
+            client.post(f"/users/stop-following/{self.u2_id}")
+
+            self.assertEqual(TimelineEntry.messages_for(self.u1_id).all(), [])
+
+    def test_follow_counters(self):
+        """Test follow/unfollow keep follower and following counts in step"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            client.post(f"/users/follow/{self.u2_id}")
+
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual(u1.following_count, 1)
+            self.assertEqual(u2.followers_count, 1)
+
+            client.post(f"/users/stop-following/{self.u2_id}")
+            db.session.expire_all()
+            self.assertEqual(u1.following_count, 0)
+            self.assertEqual(u2.followers_count, 0)
+
+    def test_reconcile_counts(self):
+        """Test counters are recomputed from the base tables"""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        m1 = Message(text="u2 message", user_id=self.u2_id)
+        u1.following.append(u2)
+        db.session.add(m1)
+        db.session.flush()
+        db.session.add(Like(user_id=self.u1_id, message_id=m1.id))
+        db.session.commit()
+
+        User.reconcile_counts()
+        db.session.commit()
+        db.session.expire_all()
+
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u1.likes_count, 1)
+        self.assertEqual(u2.followers_count, 1)
+        self.assertEqual(u2.messages_count, 1)
+
+    def test_delete_user_counters(self):
+        """Test deleting a user decrements counts of related users"""
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        m1 = Message(text="u1 message", user_id=self.u1_id)
+        m2 = Message(text="u1 other message", user_id=self.u1_id)
+        u2.following.append(u1)
+        u1.following.append(u2)
+        db.session.add_all([m1, m2])
+        db.session.flush()
+        db.session.add_all([Like(user_id=self.u2_id, message_id=m1.id),
+                            Like(user_id=self.u2_id, message_id=m2.id)])
+        db.session.commit()
+        User.reconcile_counts()
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            client.post("/users/delete")
+
+        run_worker(batch_size=1, once=True, log=lambda line: None)
+
+        db.session.expire_all()
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual(u2.following_count, 0)
+        self.assertEqual(u2.followers_count, 0)
+        self.assertEqual(u2.likes_count, 0)
+
+    def test_delete_user_marks_deleted(self):
+        """Test a deleted user is hidden before their data is purged"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            resp = client.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+            self.assertIsNotNone(User.query.get(self.u1_id).deleted_at)
+            self.assertFalse(User.authenticate("u1", "password"))
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+            resp = client.get(f"/users/{self.u1_id}")
+            self.assertEqual(resp.status_code, 404)
+            html = client.get("/users").get_data(as_text=True)
+            self.assertNotIn("@u1<", html)
+
+    def test_pending_deletion_user_untouchable(self):
+        """Test a deleted user's messages can't be seen, liked or followed
+        before their data is purged"""
+
+        m1 = Message(text="u1 message", user_id=self.u1_id)
+        m2 = Message(text="u1 other message", user_id=self.u1_id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+        m1_id, m2_id = m1.id, m2.id
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            client.post(f"/users/follow/{self.u1_id}")
+            client.post(f"/messages/{m1_id}/like")
+            # Cached before the deletion, too
+            self.assertIn("u1 message", client.get("/").get_data(as_text=True))
+
+            request_deletion(self.u1_id)
+            db.session.commit()
+
+            for url in ["/", f"/users/{self.u2_id}/liked-messages",
+                        "/api/v1/timeline"]:
+                resp = client.get(url)
+                self.assertEqual(resp.status_code, 200, url)
+                self.assertNotIn("u1 message", resp.get_data(as_text=True),
+                                 url)
+                self.assertNotIn("u1 other message",
+                                 resp.get_data(as_text=True), url)
+
+            resp = client.get(f"/messages/{m1_id}")
+            self.assertEqual(resp.status_code, 404)
+
+            resp = client.post(f"/messages/{m2_id}/like")
+            self.assertEqual(resp.status_code, 404)
+
+            client.post(f"/users/stop-following/{self.u1_id}",
+                        headers={"Referer": "/"})
+            resp = client.post(f"/users/follow/{self.u1_id}")
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+
+    def test_deleted_user_cached_elsewhere_cannot_act(self):
+        """Test a profile cached before deletion can't be used to post"""
+
+        Follows.follow(self.u1_id, [self.u2_id])
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            client.get("/messages/new")
+
+            # Deleted in another worker, which can't evict this one's copy
+            request_deletion(self.u1_id)
+            db.session.commit()
+
+            resp = client.post("/messages/new", data={"text": "too late"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Message.query.count(), 0)
+
+            # Left for the purge, which also fixes u2's followers count
+            resp = client.post(f"/users/stop-following/{self.u2_id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.count(), 1)
+
+            with client.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+
+    def test_purged_user_cached_elsewhere_logged_out(self):
+        """Test a profile cached before the account was purged logs out"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            client.get("/")
+
+            request_deletion(self.u1_id)
+            db.session.commit()
+            run_worker(batch_size=100, once=True, log=lambda line: None)
+            # As if the cached counters had expired
+            counter_cache.clear()
+
+            resp = client.get("/")
+            self.assertEqual(resp.status_code, 302)
+
+            with client.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+
+    def test_delete_user_purge_resumes(self):
+        """Test an interrupted purge resumes from its recorded stage"""
+
+        for i in range(3):
+            db.session.add(Message(text=f"m{i}", user_id=self.u1_id))
+        db.session.commit()
+
+        request_deletion(self.u1_id)
+        db.session.commit()
+
+        # Simulate a worker that died part way through purging messages
+        deletion = AccountDeletion.query.get(self.u1_id)
+        deletion.stage = "messages"
+        deletion.claimed_until = datetime.utcnow() - timedelta(seconds=1)
+        Message.query.filter_by(text="m0").delete()
+        db.session.commit()
+
+        run_worker(batch_size=2, once=True, log=lambda line: None)
+
+        db.session.expire_all()
+        deletion = AccountDeletion.query.get(self.u1_id)
+        self.assertEqual(deletion.stage, "done")
+        self.assertIsNotNone(deletion.completed_at)
+        self.assertEqual(deletion.rows_deleted, 3)
+        self.assertIsNone(User.query.get(self.u1_id))
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_edit_profile_invalidates_cached_user(self):
+        """Test editing profile shows new username on the next request"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.get("/users/edit-profile")
+            resp = client.post("/users/edit-profile", data={
+                "username": "u1-renamed",
+                "email": "u1@email.com",
+                "password": "password",
+            })
+            self.assertEqual(resp.status_code, 302)
+
+            html = client.get("/messages/new").get_data(as_text=True)
+            self.assertIn('alt="u1-renamed"', html)
+
+    ########################################################################
+    # SQL instrumentation tests
+
+    def test_sql_endpoint_stats(self):
+        """Test statements are counted per endpoint"""
+
+        reset_endpoint_stats()
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            client.get("/users")
+            client.get("/users")
+
+        stats = endpoint_stats()["list_users"]
+        self.assertEqual(stats["requests"], 2)
+        self.assertGreater(stats["statements"], 0)
+
+    def test_sql_failed_statement_not_counted(self):
+        """Test a failing statement leaves no timer on its connection"""
+
+        with app.test_request_context():
+            with db.engine.connect() as conn:
+                with self.assertRaises(ProgrammingError):
+                    conn.execute(db.text("SELECT no_such_column FROM users"))
+                conn.rollback()
+                conn.execute(db.text("SELECT 1"))
+
+                self.assertNotIn("query_start", conn.info)
+
+            self.assertEqual(g.sql_stats["statements"], 1)
+
+    def test_sql_slow_query_log_redacts_parameters(self):
+        """Test slow statements are logged without parameter values"""
+
+        app.config['SQL_SLOW_QUERY_MS'] = 0
+
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                with self.assertLogs("warbler.sql", "WARNING") as logs:
+                    client.get("/users?q=secret-term")
+        finally:
+            app.config['SQL_SLOW_QUERY_MS'] = 100
+
+        output = "\n".join(logs.output)
+        self.assertIn("slow_query", output)
+        self.assertNotIn("secret-term", output)
+
+    def test_cache_metrics_logged(self):
+        """Test cache metrics are logged once the interval has passed"""
+
+        app.config['CACHE_METRICS_INTERVAL'] = 0.001
+
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                with self.assertLogs("warbler.cache", "INFO") as logs:
+                    client.get("/")
+        finally:
+            app.config['CACHE_METRICS_INTERVAL'] = 300
+
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(line["event"], "cache_metrics")
+        self.assertIn("hit_rate", line["caches"]["users"])